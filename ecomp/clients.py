@@ -1,6 +1,13 @@
 
 from urllib import parse
+
 import requests
+from requests import adapters
+from urllib3.util import retry
+
+# Connection errors, such as a pooled connection the server has closed,
+# are retried this many times, backing off a little between each.
+RETRIES = retry.Retry(total=3, backoff_factor=0.1, status=0)
 
 
 class PrefixedSession(requests.Session):
@@ -14,3 +21,26 @@ class PrefixedSession(requests.Session):
             url = parse.urljoin(self.prefix_url, url)
         return super(PrefixedSession, self).request(
             method, url, *args, **kwargs)
+
+
+def pooled_session(prefix_url=None, pool_size=10):
+    """A PrefixedSession that keeps up to pool_size connections alive
+    per host and retries on connection errors.
+    """
+    session = PrefixedSession(prefix_url=prefix_url)
+    adapter = adapters.HTTPAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size,
+                                   max_retries=RETRIES)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def placement_session(endpoint, pool_size=10):
+    """A pooled session for talking to placement at endpoint."""
+    session = pooled_session(prefix_url=endpoint, pool_size=pool_size)
+    session.headers.update({'x-auth-token': 'admin',
+                            'openstack-api-version': 'placement latest',
+                            'accept': 'application/json',
+                            'content-type': 'application/json'})
+    return session
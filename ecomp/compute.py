@@ -1,39 +1,84 @@
 
+import collections
+import contextlib
 import io
 import functools
 import json
 import os
 import multiprocessing
-import re
 import shutil
 import signal
+import socket
 import subprocess
 import sys
+import threading
 import time
 import uuid
+from xml.etree import ElementTree
 
-import cachecontrol
-from cachecontrol.caches import file_cache
-from cachecontrol import serialize
 import etcd3
 import libvirt
-import msgpack
 import psutil
-import requests
 import yaml
 
 from ecomp import clients
 from ecomp import conf
+from ecomp import images
+from ecomp import leases
+from ecomp import metrics
+from ecomp import numa
+from ecomp import pipeline
+from ecomp import storage
+from ecomp import trace
 
 
-# Locked shared around the children.
-LOCK = multiprocessing.Lock()
 LOCK_INVENTORY = lambda: sys.exit(1)  # noqa
 
 KEY = '/hosts'
+# Images to prefetch are put under IMAGES_KEY, and each compute lists
+# the images it has at WARM_KEY/<uuid>.
+IMAGES_KEY = '/images'
+WARM_KEY = '/warm'
+# Each compute keeps ALIVE_KEY/<uuid> for as long as its lease lives.
+ALIVE_KEY = '/alive'
+# Each compute publishes a summary of its load at LOAD_KEY/<uuid>.
+LOAD_KEY = '/load'
+# Requests handed back, to be scheduled again by eschedule daemon.
+REQUESTS_KEY = '/requests'
+# A summary of build timings, if metrics_etcd, at METRICS_KEY/<uuid>.
+METRICS_KEY = '/metrics'
 SLEEP = 1
 CLIENT = None
 COMPUTE_UUID = None
+# What other computes have published at WARM_KEY, by compute uuid, and
+# the uuids of those with a key under ALIVE_KEY.
+PEERS = {}
+ALIVE = set()
+# Watches for the IP addresses of booting guests, in the parent.
+LEASES = None
+# The stages of a build, by name, in the parent. See main_loop.
+STAGES = {}
+# The requests being handled, as (etcd revision, key) pairs, and the
+# latest revision seen. Requests put in one transaction, such as a
+# batch from eschedule, share a revision. Everything before the lowest
+# revision in flight has been handled. See _finished.
+IN_FLIGHT = set()
+LAST_SEEN = 0
+REVISION_LOCK = threading.Lock()
+# What we last told placement the inventory of each of our providers
+# is, with the provider generation that gave, by provider uuid. Changed
+# by _set_inventory.
+INVENTORY = {}
+INVENTORY_RETRIES = 3
+# The latest load summary, see _load.
+LOAD = {'busy': False, 'pressure': False}
+# The etcd lease this compute keeps alive while it runs. Keys that are
+# only true while we are running, such as /booted/<instance>, use it.
+ETCD_LEASE = None
+# What each pool worker keeps for its lifetime, see _init_worker.
+CONN = None
+PLACEMENT = None
+HTTP = None
 
 # default config
 CONFIG = {
@@ -49,6 +94,90 @@ CONFIG = {
     # By default we only use the 'default' libvirt network.
     # If bridge is defined that will be used too.
     'bridge': None,
+    # Where fetched images are kept, and how much disk, in GB, they
+    # may use before the least recently used are evicted.
+    'image_store': '.images',
+    'image_budget_gb': 20,
+    # Check cached images with the origin (using ETag or Last-Modified)
+    # before using them.
+    'image_revalidate': False,
+    # How many parallel range requests to use to fetch large images.
+    'image_ranges': 4,
+    # Make instance disks qcow2 overlays on the cached image, grown to
+    # the allocated size, leaving the guest to grow its filesystem.
+    # When set, resize is ignored.
+    'overlay': False,
+    # Directories to keep instance disks in. Each new disk goes in the
+    # one whose device has the fewest I/Os in flight, then the most
+    # free space, among those with room for it.
+    'storage': ['.'],
+    # Serve cached images to other computes on this port, and fetch
+    # images from them before going to the origin. Anyone who can reach
+    # it can read every cached image. None to disable.
+    'peer_port': None,
+    # The address to serve on, which other computes use to reach it.
+    'peer_address': socket.getfqdn(),
+    # The libvirt network guests get their first IP from, the
+    # dnsmasq file that changes when it hands out a lease, and how
+    # many seconds to wait for one.
+    'network': 'default',
+    'lease_file': '/var/lib/libvirt/dnsmasq/virbr0.status',
+    'ip_timeout': 100,
+    # The libvirt domain type, 'qemu' if the host cannot do kvm.
+    'domain_type': 'kvm',
+    # How many builds may be in each stage at once: fetching images,
+    # preparing instance disks, and defining and starting (or
+    # destroying) domains. Waiting for an IP takes no worker.
+    'fetch_workers': 4,
+    'prepare_workers': multiprocessing.cpu_count() // 2 or 1,
+    'start_workers': 2,
+    # How many builds may wait in front of each stage.
+    'stage_queue': 64,
+    # Where to keep the etcd revision up to which requests for this
+    # compute have been handled, so they are not lost over a restart.
+    'revision_file': '.ecompute.revision',
+    # Seconds our etcd lease lasts without being refreshed.
+    'lease_ttl': 30,
+    # Delete requests under /hosts/<uuid>/ once they are handled.
+    'delete_handled': True,
+    # Every compact_interval seconds compact etcd history older than
+    # compact_window revisions. Set compact_window to None to not.
+    'compact_window': 10000,
+    'compact_interval': 300,
+    # Publish a summary of our load every load_interval seconds. We are
+    # busy when cpu steal or the busiest disk are over max_steal or
+    # max_io_busy percent, or when max_builds or more are in progress.
+    # With max_builds set, new builds that come while we are busy are
+    # handed back to be scheduled elsewhere, which needs eschedule
+    # daemon running. By default every build is accepted.
+    'load_interval': 5,
+    'max_builds': None,
+    'max_steal': 20,
+    'max_io_busy': 90,
+    # Work out inventory again every inventory_interval seconds and
+    # update placement if any of it has moved by more than the
+    # inventory_threshold fraction of its total.
+    'inventory_interval': 60,
+    'inventory_threshold': 0.02,
+    # Report each NUMA node as a child resource provider with its own
+    # VCPU and MEMORY_MB, and keep each guest's vCPUs and memory on the
+    # node it was allocated. See ecomp.numa.
+    'numa': False,
+    # With numa, back guest memory with hugepages of this many kB (such
+    # as 2048) from the node, or None not to.
+    'hugepage_kb': None,
+    # Where the node and hugepages of each instance are recorded.
+    'numa_state': '.numa',
+    # Serve build timings, queue depths and image cache hits at
+    # /metrics on this port and address, in the Prometheus text format.
+    # None to disable. With metrics_etcd, also publish a summary to etcd
+    # every load_interval seconds.
+    'metrics_port': None,
+    'metrics_address': 'localhost',
+    'metrics_etcd': False,
+    # Append the spans of builds, continuing the traces eschedule starts,
+    # to this file. None to not. See ecomp.trace.
+    'trace_file': None,
 }
 
 
@@ -64,19 +193,6 @@ def _exit(*args):
 signal.signal(signal.SIGINT, _exit)
 
 
-# deal with size limitations in CacheControl
-class MySerializer(serialize.Serializer):
-
-    def _loads_v4(self, request, data):
-        try:
-            cached = msgpack.loads(
-                data, encoding="utf-8", max_bin_len=2147483647)
-        except ValueError:
-            return
-
-        return self.prepare_response(request, cached)
-
-
 def _print(output):
     print('%s: PID: %s [%s] %s' % (
         time.time(), os.getpid(), COMPUTE_UUID, output))
@@ -86,32 +202,33 @@ def main(config):
     """Set up the resource provider for this compute and start
     the main loop.
     """
-    global LOCK_INVENTORY, COMPUTE_UUID
+    global LOCK_INVENTORY, COMPUTE_UUID, PLACEMENT
     compute_uuid = config['uuid']
     COMPUTE_UUID = compute_uuid
-    session = clients.PrefixedSession(
-        prefix_url=config['placement']['endpoint'])
-    session.headers.update({'x-auth-token': 'admin',
-                            'openstack-api-version': 'placement latest',
-                            'accept': 'application/json',
-                            'content-type': 'application/json'})
-    # Inventory is "FOO:1,BAR:2, BAZ:8"
-    inventory_dict = _calculate_inventory()
-    _print(inventory_dict)
-
-    inventories_dict = {}
-    for resource_class, value in inventory_dict.items():
-        inventories_dict[resource_class] = {
-            'total': int(value)
-            # For now use defaults for the rest of the fields
-        }
+    session = clients.placement_session(config['placement']['endpoint'])
+    # The parent uses this session too, pool workers make their own.
+    PLACEMENT = session
+    for path in config['storage']:
+        os.makedirs(path, exist_ok=True)
+    inventories_dict = _calculate_inventory(config)
+    _print(inventories_dict)
 
-    if not confirm_resource_provider(session, compute_uuid, inventories_dict):
-        generation = _create_resource_provider(session, compute_uuid)
-        _set_inventory(session, compute_uuid, generation, inventories_dict)
+    # The compute comes first, as the parent of any NUMA nodes.
+    for rp_uuid, inventories in inventories_dict.items():
+        if not confirm_resource_provider(session, rp_uuid, inventories):
+            parent = None if rp_uuid == compute_uuid else compute_uuid
+            generation = _create_resource_provider(session, rp_uuid, parent)
+            if _set_inventory(session, rp_uuid, generation,
+                              inventories) is None:
+                sys.exit(1)
 
-    LOCK_INVENTORY = _create_lock_inventory(
-        session, compute_uuid, inventories_dict)
+    locks = [_create_lock_inventory(session, rp_uuid, provider['inventories'])
+             for rp_uuid, provider in INVENTORY.items()
+             if 'VCPU' in provider['inventories']]
+
+    def _lock_inventory():
+        return all([lock() for lock in locks])
+    LOCK_INVENTORY = _lock_inventory
 
     main_loop(config, compute_uuid)
 
@@ -127,7 +244,8 @@ def confirm_resource_provider(session, rp_uuid, inventories):
             ['%s: %s' % (rc, value) for rc, value in data['usages'].items()])
         _print('Existing resource provider with gen %s '
                'found with usages: %s.' % (generation, usage))
-        _set_inventory(session, rp_uuid, generation, inventories)
+        if _set_inventory(session, rp_uuid, generation, inventories) is None:
+            sys.exit(1)
         return True
     return False
 
@@ -159,211 +277,1050 @@ def _create_lock_inventory(session, rp_uuid, inventories):
     return _lock_inventory
 
 
-def _calculate_inventory():
+def _calculate_inventory(config):
+    """Work out inventory, by provider uuid, reserving the disk used by
+    anything other than instance disks, such as cached images.
+
+    With numa, VCPU and MEMORY_MB are on a child provider for each NUMA
+    node rather than on the compute.
+    """
     cpu = psutil.cpu_count()
-    # We only measure this disk space of where we store images.
-    # Clearly disk in use matters here, but we don't know what's
-    # images and what's other stuff, so fake it for now.
-    disk = psutil.disk_usage('.').total // 1024 // 1024 // 1024
     memory = psutil.virtual_memory().total // 1024 // 1024
-    return {
-        'VCPU': cpu,
-        'DISK_GB': disk,
-        'MEMORY_MB': memory,
+    # We only measure the disks where we store instances, each once.
+    total = used = 0
+    for path in storage.devices(config['storage']):
+        disk = psutil.disk_usage(path)
+        total += disk.total
+        used += disk.used
+    disk_total = total // images.GB
+    other = (used - storage.instance_bytes(config['storage'])) // images.GB
+    inventories = {
+        'DISK_GB': {'total': disk_total,
+                    'reserved': min(max(other, 0), disk_total)},
     }
+    if not config['numa']:
+        inventories['VCPU'] = {'total': cpu}
+        inventories['MEMORY_MB'] = {'total': memory}
+        return {config['uuid']: inventories}
+    providers = {config['uuid']: inventories}
+    for node, topology in numa.nodes().items():
+        providers[numa.provider_uuid(config['uuid'], node)] = {
+            'VCPU': {'total': len(topology['cpus'])},
+            'MEMORY_MB': {'total': topology['memory_mb']},
+        }
+    return providers
 
 
-def handle_build(instance, response):
+def _inventory_changed(config, old, new):
+    """Say if any total or reserved has moved by more than the
+    inventory_threshold fraction of its total.
+    """
+    if set(old) != set(new):
+        return True
+    for resource_class, inventory in new.items():
+        limit = config['inventory_threshold'] * max(inventory['total'], 1)
+        for field in ('total', 'reserved'):
+            change = abs(inventory.get(field, 0)
+                         - old[resource_class].get(field, 0))
+            if change > limit:
+                return True
+    return False
+
+
+def _report_inventory(config):
+    """Every inventory_interval seconds, work out inventory again and
+    update placement if it has changed enough.
+    """
+    def _report():
+        while True:
+            time.sleep(config['inventory_interval'])
+            try:
+                for rp_uuid, inventories in _calculate_inventory(
+                        config).items():
+                    current = INVENTORY[rp_uuid]
+                    if not _inventory_changed(
+                            config, current['inventories'], inventories):
+                        continue
+                    _print('inventory of %s changed to %s' % (
+                        rp_uuid, inventories))
+                    if 'VCPU' in inventories:
+                        # Keep a VCPU reservation made by LOCK_INVENTORY.
+                        inventories['VCPU']['reserved'] = (
+                            current['inventories']['VCPU'].get(
+                                'reserved', 0))
+                    _set_inventory(PLACEMENT, rp_uuid,
+                                   current['generation'], inventories)
+            except Exception as exc:
+                _print('inventory reporting saw %s' % exc)
+
+    threading.Thread(target=_report, daemon=True).start()
+
+
+def handle_build(config, instance, request, response):
     if response is False:
         _print('updating etcd for dead instance: %s' % instance)
-        CLIENT.delete('/booted/%s' % instance)
+        STAGES['report'].submit(CLIENT.delete, ('/booted/%s' % instance,))
+    elif response is True:
+        metrics.phase(instance, 'start')
+        # The build may have brought in a new image.
+        STAGES['report'].submit(publish_warm, (config,))
+        LEASES.wait(instance, functools.partial(handle_ip, instance))
     else:
+        _print('request for instance %s failed' % instance)
+        metrics.finish(instance, 'failed')
+        trace.finish(instance, 'failed')
+    _finished(config, request)
+
+
+def handle_ip(instance, ip_address):
+    metrics.phase(instance, 'ip')
+    trace.phase(instance, 'ip')
+    outcome = 'booted' if ip_address else 'no_ip'
+    if ip_address:
         _print('updating etcd for instance %s with ip %s' % (
-            instance, response))
-        CLIENT.put('/booted/%s' % instance, response)
+            instance, ip_address))
+        STAGES['report'].submit(
+            _put_booted, (instance, ip_address), None, handle_error)
+    else:
+        _print('instance %s acquired no IP' % instance)
+    timings = metrics.finish(instance, outcome)
+    trace.finish(instance, outcome)
+    if timings:
+        _print('timings for %s: %s' % (instance, ', '.join(
+            '%s %.2fs' % (name, seconds)
+            for name, seconds in timings.items())))
+
+
+def _put_booted(instance, ip_address):
+    """Record the IP of instance, for as long as we are alive."""
+    CLIENT.put('/booted/%s' % instance, ip_address, lease=ETCD_LEASE)
+
+
+def handle_fetched(config, request, data):
+    metrics.phase(data['instance'], 'fetch')
+    metrics.inc('ecompute_image_cache_total',
+                result='hit' if data.pop('image_hit') else 'miss')
+    STAGES['prepare'].submit(
+        _prepare_disk, (config, data),
+        functools.partial(handle_prepared, config, request),
+        functools.partial(handle_build_failed, config, data['instance'],
+                          request),
+        data['instance'])
+
+
+def handle_prepared(config, request, data):
+    metrics.phase(data['instance'], 'prepare')
+    STAGES['start'].submit(
+        _start_domain, (config, data),
+        functools.partial(handle_build, config, data['instance'], request),
+        functools.partial(handle_build_failed, config, data['instance'],
+                          request),
+        data['instance'])
+
+
+def handle_failed(config, instance, request, exc):
+    handle_error(exc)
+    metrics.finish(instance, 'failed')
+    trace.finish(instance, 'failed')
+    _finished(config, request)
+
+
+def handle_build_failed(config, instance, request, exc):
+    """A stage of a build failed, or its worker died: give up what the
+    build got before the request is finished.
+    """
+    STAGES['report'].submit(_give_up, (config, instance), None,
+                            handle_error)
+    handle_failed(config, instance, request, exc)
+
+
+def _give_up(config, instance):
+    """Clear up after a failed build: its domain, if it got one, its
+    disk, what it held and its allocations.
+    """
+    try:
+        _destroy(config, instance)
+    except (libvirt.libvirtError, OSError) as exc:
+        _print('\tfailed to clean up %s: %s' % (instance, exc))
+    _release(instance)
+
+
+def _load_revision(config):
+    try:
+        with open(config['revision_file']) as revision_file:
+            return int(revision_file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _started(revision, key):
+    """Note that the request at key and revision is being handled, and
+    return it, to be given to _finished.
+    """
+    global LAST_SEEN
+    request = (revision, key)
+    with REVISION_LOCK:
+        IN_FLIGHT.add(request)
+        LAST_SEEN = max(LAST_SEEN, revision)
+    return request
+
+
+def _finished(config, request):
+    """Note that request, from _started, is handled and, if we are
+    deleting handled requests, delete it unless it has been replaced.
+    """
+    with REVISION_LOCK:
+        IN_FLIGHT.discard(request)
+        _save_revision(config)
+    revision, key = request
+    if config['delete_handled']:
+        STAGES['report'].submit(_delete_request, (key, revision), None,
+                                handle_error)
+
+
+def _delete_request(key, revision):
+    CLIENT.transaction(
+        compare=[CLIENT.transactions.mod(key) == revision],
+        success=[CLIENT.transactions.delete(key)],
+        failure=[])
+
+
+def _save_revision(config):
+    """Save the revision up to which every request is handled. Call
+    with REVISION_LOCK held.
+    """
+    if IN_FLIGHT:
+        handled = min(revision for revision, _ in IN_FLIGHT) - 1
+    else:
+        handled = LAST_SEEN
+    tmp_file = '%s.tmp' % config['revision_file']
+    with open(tmp_file, 'w') as revision_file:
+        revision_file.write(str(handled))
+    os.rename(tmp_file, config['revision_file'])
 
 
 def handle_error(exc):
     _print('child saw %s' % exc)
 
 
+def publish_warm(config, *args):
+    """Put the urls and digests of the images we have to etcd, along
+    with where peers can get them from.
+    """
+    warm = {entry['url']: {'digest': entry['digest'],
+                           'etag': entry['etag'],
+                           'last_modified': entry['last_modified']}
+            for entry in images.cached(config['image_store'])}
+    endpoint = None
+    if config['peer_port']:
+        endpoint = 'http://%s:%s' % (config['peer_address'],
+                                     config['peer_port'])
+    # The advert goes when our lease does, so a dead compute is not
+    # asked for images. _heartbeat puts it again on a new lease.
+    CLIENT.put('%s/%s' % (WARM_KEY, config['uuid']),
+               json.dumps({'endpoint': endpoint, 'images': warm}),
+               lease=ETCD_LEASE)
+
+
+def _watch_peers(config):
+    """Keep PEERS up to date with what other computes have, and ALIVE
+    with which of them are alive.
+    """
+    def _peer(key):
+        return str(key, 'UTF-8').rsplit('/', 1)[1]
+
+    def _update_warm(key, value):
+        peer = _peer(key)
+        if peer == config['uuid']:
+            return
+        if value:
+            PEERS[peer] = json.loads(str(value, 'UTF-8'))
+        else:
+            PEERS.pop(peer, None)
+
+    def _update_alive(key, value):
+        if value:
+            ALIVE.add(_peer(key))
+        else:
+            ALIVE.discard(_peer(key))
+
+    def _watch_callback(update, response):
+        if isinstance(response, Exception):
+            _print('peer watch saw %s' % response)
+            return
+        for event in response.events:
+            if isinstance(event, etcd3.events.PutEvent):
+                update(event.key, event.value)
+            else:
+                update(event.key, None)
+
+    for prefix, update in ((WARM_KEY, _update_warm),
+                           (ALIVE_KEY, _update_alive)):
+        for value, meta in CLIENT.get_prefix(prefix + '/'):
+            update(meta.key, value)
+        CLIENT.add_watch_prefix_callback(
+            prefix + '/', functools.partial(_watch_callback, update))
+
+
+def _peers_for(image):
+    """Return (blob url, digest, ETag, Last-Modified) for peers that
+    are alive and have image.
+    """
+    peers = []
+    for peer, advert in list(PEERS.items()):
+        warm = advert['images'].get(image)
+        if warm and advert['endpoint'] and peer in ALIVE:
+            peers.append((
+                '%s/blobs/%s' % (advert['endpoint'], warm['digest']),
+                warm['digest'], warm['etag'], warm['last_modified']))
+    return peers
+
+
+def _low_priority(config):
+    """Make a pool worker yield cpu and disk to the build workers."""
+    _init_worker(config)
+    os.nice(19)
+    psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+
+
+def _watch_images(config, warm_pool):
+    """Prefetch listed images now and whenever the list changes."""
+    success = functools.partial(publish_warm, config)
+
+    def _prefetch_image(url):
+        _print('PREFETCHING %s' % url)
+        warm_pool.apply_async(_prefetch, (config, url, _peers_for(url)), {},
+                              success, handle_error)
+
+    def _watch_callback(response):
+        if isinstance(response, Exception):
+            _print('image watch saw %s' % response)
+            return
+        for event in response.events:
+            if isinstance(event, etcd3.events.PutEvent):
+                _prefetch_image(str(event.value, 'UTF-8'))
+
+    for value, _ in CLIENT.get_prefix(IMAGES_KEY + '/'):
+        _prefetch_image(str(value, 'UTF-8'))
+    CLIENT.add_watch_prefix_callback(IMAGES_KEY + '/', _watch_callback)
+
+
+def _stages(config):
+    """Make the stages builds go through."""
+    worker = {'initializer': _init_worker, 'initargs': (config,)}
+    queue_size = config['stage_queue']
+    return {
+        'fetch': pipeline.Stage(
+            'fetch', config['fetch_workers'], queue_size, **worker),
+        'prepare': pipeline.Stage(
+            'prepare', config['prepare_workers'], queue_size, **worker),
+        'start': pipeline.Stage(
+            'start', config['start_workers'], queue_size, **worker),
+        # Reporting to etcd happens in threads in this process.
+        'report': pipeline.Stage(
+            'report', 1, queue_size, threads=True),
+    }
+
+
+def _load_request(key, value):
+    """Return the request found at key, or None if it is not one. This
+    runs in the main loop, so a bad message must not raise.
+    """
+    try:
+        data = json.loads(str(value, 'UTF-8'))
+    except ValueError:
+        data = None
+    if (not isinstance(data, dict) or 'instance' not in data
+            or not isinstance(data.get('allocations'), dict)
+            or (data['allocations'] and 'image' not in data)):
+        _print('weird data at %s: %s' % (key, value))
+        return None
+    return data
+
+
+def _dispatch(config, data, key, revision):
+    """Start handling the request in data, found at key and revision."""
+    instance = data['instance']
+    _print('MANAGE INSTANCE %s WITH IMAGE %s' % (instance, data.get('image')))
+    _print('\tALLOCATIONS ARE %(allocations)s' % data)
+    if isinstance(data.get('trace'), dict):
+        _print('\tTRACE %s' % data['trace'].get('trace_id'))
+    # Decide before this build is counted as in flight.
+    busy = data['allocations'] and _busy(config)
+    request = _started(revision, key)
+    error = functools.partial(handle_failed, config, instance, request)
+
+    if busy:
+        _print('\tBUSY, handing back %s' % instance)
+        STAGES['report'].submit(
+            _hand_back, (config, data),
+            functools.partial(handle_handed_back, config, data, request),
+            error)
+    elif data['allocations']:
+        _build(config, data, request)
+    else:
+        STAGES['start'].submit(
+            _handle_destroy, (config, data),
+            functools.partial(handle_build, config, instance, request),
+            error)
+
+
+def _build(config, data, request):
+    """Send the build in data to the first stage."""
+    instance = data['instance']
+    metrics.start(instance)
+    trace.begin(instance, data.get('trace'))
+    peers = _peers_for(data['image'])
+    STAGES['fetch'].submit(
+        _fetch_image, (config, data, peers),
+        functools.partial(handle_fetched, config, request),
+        functools.partial(handle_build_failed, config, instance, request),
+        instance)
+
+
+def _busy(config):
+    if config['max_builds'] is None:
+        return False
+    with REVISION_LOCK:
+        builds = len(IN_FLIGHT)
+    return builds >= config['max_builds'] or LOAD['pressure']
+
+
+def _resources(data):
+    """Return the resources allocated in data, summed over providers,
+    which may be the compute and one of its NUMA nodes.
+    """
+    resources = collections.Counter()
+    for allocation in data['allocations'].values():
+        resources.update(allocation['resources'])
+    return resources
+
+
+def _resources_query(data):
+    """Turn the allocations in data back into a resources query."""
+    resources = _resources(data)
+    return 'resources=%s' % ','.join(
+        '%s:%s' % (resource_class, amount)
+        for resource_class, amount in sorted(resources.items()))
+
+
+def _hand_back(config, data):
+    """Give up the allocations for a build and ask for it to be
+    scheduled again, anywhere but here, by eschedule daemon.
+
+    Returns False if the allocations could not be given up, and the
+    build is to be done here after all.
+    """
+    instance = data['instance']
+    if not _release(instance):
+        return False
+    request = {
+        'resources': _resources_query(data),
+        'image': data['image'],
+        'instance': instance,
+        'exclude': [config['uuid']],
+    }
+    if data.get('metadata'):
+        request['metadata'] = data['metadata']
+    key = '%s/%s' % (REQUESTS_KEY, instance)
+    # Clear any result from an earlier time it was handed back.
+    CLIENT.transaction(
+        compare=[],
+        success=[CLIENT.transactions.put(key, json.dumps(request)),
+                 CLIENT.transactions.delete('%s/result' % key)],
+        failure=[])
+    return True
+
+
+def handle_handed_back(config, data, request, handed_back):
+    if handed_back:
+        _finished(config, request)
+    else:
+        _print('\tbuilding %s here' % data['instance'])
+        _build(config, data, request)
+
+
+def _load(config, io_before):
+    """Return a summary of our load, and disk counters for next time."""
+    io_now = psutil.disk_io_counters(perdisk=True)
+    elapsed_ms = config['load_interval'] * 1000
+    io_busy = 0
+    for disk, counters in io_now.items():
+        if disk in io_before and hasattr(counters, 'busy_time'):
+            busy_ms = counters.busy_time - io_before[disk].busy_time
+            io_busy = max(io_busy, 100 * busy_ms / elapsed_ms)
+    steal = getattr(psutil.cpu_times_percent(), 'steal', 0)
+    with REVISION_LOCK:
+        builds = len(IN_FLIGHT)
+    load = {
+        'builds': builds,
+        'fetch': STAGES['fetch'].depth(),
+        'prepare': STAGES['prepare'].depth(),
+        'start': STAGES['start'].depth(),
+        'ip': len(LEASES.pending),
+        'io_busy': round(io_busy, 1),
+        'steal': steal,
+        'time': time.time(),
+    }
+    load['pressure'] = (steal > config['max_steal']
+                        or io_busy > config['max_io_busy'])
+    load['busy'] = bool(load['pressure'] or (
+        config['max_builds'] is not None
+        and builds >= config['max_builds']))
+    return load, io_now
+
+
+def _publish_load(config):
+    """Publish a summary of our load every load_interval seconds."""
+    def _publish():
+        global LOAD
+        io_before = psutil.disk_io_counters(perdisk=True)
+        psutil.cpu_times_percent()
+        while True:
+            time.sleep(config['load_interval'])
+            try:
+                LOAD, io_before = _load(config, io_before)
+                CLIENT.put('%s/%s' % (LOAD_KEY, config['uuid']),
+                           json.dumps(LOAD), lease=ETCD_LEASE)
+                if config['metrics_etcd']:
+                    CLIENT.put('%s/%s' % (METRICS_KEY, config['uuid']),
+                               json.dumps(metrics.summary()),
+                               lease=ETCD_LEASE)
+            except Exception as exc:
+                _print('load publishing saw %s' % exc)
+
+    threading.Thread(target=_publish, daemon=True).start()
+
+
+def _gauges():
+    """Return the gauges served with the metrics."""
+    gauges = {('ecompute_stage_depth', (('stage', name),)): stage.depth()
+              for name, stage in STAGES.items()}
+    with REVISION_LOCK:
+        gauges[('ecompute_builds_in_flight', ())] = len(IN_FLIGHT)
+    gauges[('ecompute_waiting_for_ip', ())] = len(LEASES.pending)
+    hit_ratio = metrics.summary()['image_hit_ratio']
+    if hit_ratio is not None:
+        gauges[('ecompute_image_cache_hit_ratio', ())] = hit_ratio
+    return gauges
+
+
+def _heartbeat(config):
+    """Make a new ETCD_LEASE and say we are alive, and what images we
+    have, with it.
+    """
+    global ETCD_LEASE
+    ETCD_LEASE = CLIENT.lease(config['lease_ttl'])
+    CLIENT.put('%s/%s' % (ALIVE_KEY, config['uuid']), str(time.time()),
+               lease=ETCD_LEASE)
+    publish_warm(config)
+
+
+def _keep_alive(config):
+    """Keep ETCD_LEASE alive, making a new one if it expires. While it
+    is alive so is our key under ALIVE_KEY, which schedulers check.
+    """
+    _heartbeat(config)
+
+    def _refresh():
+        while True:
+            time.sleep(config['lease_ttl'] / 3)
+            try:
+                ttl = ETCD_LEASE.refresh()[0].TTL
+            except Exception as exc:
+                _print('lease refresh saw %s' % exc)
+                continue
+            if ttl <= 0:
+                _print('lease expired, making a new one')
+                _heartbeat(config)
+                _republish_booted()
+
+    threading.Thread(target=_refresh, daemon=True).start()
+
+
+def _republish_booted():
+    """Put the IPs of running instances to /booted/ again."""
+    conn = libvirt.open('qemu:///system')
+    try:
+        domains = [dom.name() for dom in conn.listAllDomains()
+                   if dom.isActive()]
+    finally:
+        conn.close()
+    for instance in domains:
+        if storage.is_instance(instance):
+            LEASES.wait(instance, functools.partial(handle_ip, instance))
+
+
+def _compact(config):
+    """Compact etcd history older than compact_window revisions, every
+    compact_interval seconds.
+    """
+    def _maintain():
+        compacted = 0
+        while True:
+            time.sleep(config['compact_interval'])
+            try:
+                revision = CLIENT.get_response(KEY).header.revision
+                target = revision - config['compact_window']
+                if target > compacted:
+                    CLIENT.compact(target)
+                    compacted = target
+                    _print('compacted etcd to revision %s' % target)
+            except Exception as exc:
+                # Another compute may have got there first.
+                _print('compaction saw %s' % exc)
+
+    threading.Thread(target=_maintain, daemon=True).start()
+
+
+def _reconcile(config, our_key):
+    """Compare the requests for this host with what is running and what
+    is booted, and do what is needed to make them match.
+
+    Only requests after the saved revision are looked at, or all of
+    them if there is none. Returns the revision to watch from.
+    """
+    global LAST_SEEN
+    saved = _load_revision(config)
+    response = CLIENT.get_prefix_response(our_key)
+    # /booted/ keys by instance, with the lease each is on.
+    booted = {str(kv.key, 'UTF-8').rsplit('/', 1)[1]: kv.lease
+              for kv in CLIENT.get_prefix_response('/booted/').kvs}
+    conn = libvirt.open('qemu:///system')
+    try:
+        domains = {dom.name(): dom.isActive()
+                   for dom in conn.listAllDomains()}
+    finally:
+        conn.close()
+    with REVISION_LOCK:
+        LAST_SEEN = response.header.revision
+
+    for kv in response.kvs:
+        if saved is not None and kv.mod_revision <= saved:
+            continue
+        data = _load_request(kv.key, kv.value)
+        if data is None:
+            continue
+        instance = data['instance']
+        if not data.get('allocations'):
+            # A destroy, which also clears up after a domain that has
+            # gone, its allocations and its /booted/ entry.
+            _print('RECONCILE: destroying %s' % instance)
+            _dispatch(config, data, kv.key, kv.mod_revision)
+            domains.pop(instance, None)
+        elif instance not in domains:
+            _print('RECONCILE: building %s' % instance)
+            _dispatch(config, data, kv.key, kv.mod_revision)
+        elif not domains[instance]:
+            # Defined, but we stopped before starting it.
+            _print('RECONCILE: starting %s' % instance)
+            request = _started(kv.mod_revision, kv.key)
+            STAGES['start'].submit(
+                _start_defined, (config, instance),
+                functools.partial(handle_build, config, instance, request),
+                functools.partial(handle_build_failed, config, instance,
+                                  request),
+                instance)
+        else:
+            # Already running, and waited for below.
+            _finished(config, _started(kv.mod_revision, kv.key))
+    # /booted/ entries go when our lease does, and handled requests
+    # are deleted, so look at every instance that is running. An entry
+    # on another lease, left by an ecompute that ran here before, goes
+    # when that lease expires, so is put again on ours.
+    for instance, active in domains.items():
+        if (active and booted.get(instance) != ETCD_LEASE.id
+                and storage.is_instance(instance)):
+            _print('RECONCILE: waiting for IP of %s' % instance)
+            LEASES.wait(instance, functools.partial(handle_ip, instance))
+    with REVISION_LOCK:
+        _save_revision(config)
+    return response.header.revision + 1
+
+
 def main_loop(config, compute_uuid):
-    """Listen for changes on the key for this host."""
+    """Listen for changes on the key for this host.
+
+    Requests missed while we were not running are found by _reconcile,
+    then the watch starts from where it left off.
+    """
+    global LEASES, STAGES
 
     our_key = '%s/%s/' % (KEY, compute_uuid)
-    events_iterator, cancel = CLIENT.watch_prefix(our_key)
+    STAGES = _stages(config)
+    with multiprocessing.Pool(processes=1, initializer=_low_priority,
+                              initargs=(config,)) as warm_pool:
+        LEASES = leases.LeaseWatcher(config['network'], config['lease_file'],
+                                     config['ip_timeout'])
+        LEASES.start()
+        if config['peer_port']:
+            images.serve(config['image_store'], config['peer_port'],
+                         config['peer_address'])
+            _watch_peers(config)
+        # This publishes what images we have, on our lease.
+        _keep_alive(config)
+        _watch_images(config, warm_pool)
 
-    cpu_count = multiprocessing.cpu_count() // 2 or 1
-    with multiprocessing.Pool(processes=cpu_count) as pool:
+        if config['metrics_port']:
+            metrics.serve(config['metrics_port'], _gauges,
+                          config['metrics_address'])
+        _publish_load(config)
+        _report_inventory(config)
+        if config['compact_window']:
+            _compact(config)
+        start_revision = _reconcile(config, our_key)
+        events_iterator, cancel = CLIENT.watch_prefix(
+            our_key, start_revision=start_revision)
         for event in events_iterator:
-            value = str(event.value, 'UTF-8')
-            data = json.loads(value)
-            instance = data['instance']
-            success = functools.partial(handle_build, instance)
-            error = handle_error
-
-            _print('PREPPING ASYNC for %s' % instance)
-            args = (config, data)
-            pool.apply_async(_handle_new, args, {}, success, error)
+            if not isinstance(event, etcd3.events.PutEvent):
+                continue
+            data = _load_request(event.key, event.value)
+            if data is not None:
+                _dispatch(config, data, event.key, event.mod_revision)
     # Shouldn't reach here.
     sys.exit(0)
 
 
-def _handle_new(config, data):
-    """Note the spawn, by sending the ip address to /booted."""
-    # And we would want to fail and unclaim (here or in
-    # the scheduler?), sometimes.
-    _print('MANAGE INSTANCE %(instance)s WITH IMAGE %(image)s' % data)
-    _print('\tALLOCATIONS ARE %(allocations)s' % data)
-    if data['allocations']:
-        _spawn(config, data)
-        ip_address = _get_ip(data['instance'])
-        _print('\tIP is %s' % ip_address)
-        return ip_address
-    elif 'allocations' in data:
-        instance = data['instance']
-        _destroy(instance)
-        del data['instance']
-        del data['image']
-        # FIXME dupe
-        session = clients.PrefixedSession(
-            prefix_url=config['placement']['endpoint'])
-        session.headers.update({'x-auth-token': 'admin',
-                                'openstack-api-version': 'placement latest',
-                                'accept': 'application/json',
-                                'content-type': 'application/json'})
-        resp = session.put('/allocations/%s' % instance, json=data)
-        if resp:
-            return False
-        else:
-            _print('\tINCOMPLETE DESTROY %s: %s' % (instance, resp))
-            sys.exit(1)
+def _prefetch(config, url, peers=None, instance=None):
+    """Get an image into the store, ready to be used for a build, and
+    return its index entry. If instance is given, the image is held for
+    it, with a ref, until let go with images.remove_ref.
+    """
+    found = {}
+    with images.fetched(config['image_store'], url, HTTP,
+                        config['image_budget_gb'], found,
+                        revalidate=config['image_revalidate'],
+                        ranges=config['image_ranges'],
+                        peers=peers) as source_file:
+        if config['overlay']:
+            images.qcow2_base(source_file)
+        if instance:
+            images.add_ref(config['image_store'], found['digest'], instance)
+    _print('PREFETCHED %s' % url)
+    return found
+
+
+def _fetch_image(config, data, peers=None):
+    """The fetch stage: get the image for a build into the store."""
+    found = _prefetch(config, data['image'], peers, data['instance'])
+    data['image_hit'] = found['hit']
+    data['image_digest'] = found['digest']
+    return data
+
+
+def _prepare_disk(config, data):
+    """The prepare stage: make the instance disk from the image the
+    fetch stage got, and holds, for it.
+    """
+    allocations = _resources(data)
+    source = images.blob_path(config['image_store'], data['image_digest'])
+    dest = _copy_image(config, source, data['instance'],
+                       allocations['DISK_GB'])
+    if not config['overlay']:
+        # A copy does not need the image any more.
+        images.remove_ref(config['image_store'], data['instance'])
+    if config['overlay']:
+        disk_format = 'qcow2'
     else:
-        _print('\thandle_new with weird data %s: %s' % (instance, data))
-        sys.exit(1)
+        disk_format = images.disk_format(dest)
+    data['disk'] = dest
+    data['disk_format'] = disk_format
+    return data
 
 
-def _spawn(config, data):
-    compute_uuid = config['uuid']
-    image = data['image']
+def _handle_destroy(config, data):
+    """Destroy an instance and clear its allocations.
+
+    Returns False, to the parent, once it is done, or None if the
+    allocations could not be cleared.
+    """
     instance = data['instance']
-    allocations = data['allocations'][compute_uuid]['resources']
-    _print(allocations)
-    memory = allocations['MEMORY_MB']
-    vcpu = allocations['VCPU']
-    disk_size = allocations['DISK_GB']
-    dest = _copy_image(config, image, instance, disk_size)
-    _print(dest)
-    args = [
-            'virt-install',
-            '--name', instance,
-            '--memory', str(memory),
-            '--vcpus', str(vcpu),
-            '--disk', dest,
-            '--graphics', 'none',
-            '--import',
-            '--noautoconsole',
-            '--network', 'network:default',
-            ]
-    bridge = config['bridge']
-    if bridge:
-        args.extend(['--network', 'bridge:%s' % bridge])
-    _print('spawning %s' % args)
-    subprocess.Popen(args)
-    _print('spawned %s' % args)
-
-
-def _destroy(instance):
-    conn = libvirt.open('qemu:///system')
-    dom = conn.lookupByName(instance)
-    if dom:
-        dom.destroy()
-        dom.undefine()
-        img = '%s.img' % instance
-        os.unlink(img)
+    _destroy(config, instance)
+    del data['instance']
+    del data['image']
+    resp = PLACEMENT.put('/allocations/%s' % instance, json=data)
+    if resp:
+        return False
+    else:
+        _print('\tINCOMPLETE DESTROY %s: %s' % (instance, resp))
+        return None
+
+
+def _init_worker(config):
+    """Make the connections a pool worker keeps for its lifetime."""
+    global PLACEMENT, HTTP
+    PLACEMENT = clients.placement_session(
+        config['placement']['endpoint'], pool_size=2)
+    # Range requests for an image all go to one host.
+    HTTP = clients.pooled_session(pool_size=config['image_ranges'])
+    _libvirt()
 
 
-def _get_ip(instance):
-    count = 100
-    # limit looping
-    while count > 0:
+def _libvirt():
+    """Return this process's libvirt connection, reconnecting if it
+    has gone away.
+    """
+    global CONN
+    if CONN is not None:
         try:
-            output = subprocess.check_output(['virsh', 'domifaddr', instance])
-            output = str(output)
-            output = output.replace('\n', ' ').rstrip()
-            output = output.split()[-1].split('/')[0]
-            if re.match(r'^\d+\.\d+\.\d+.\d+', output):
-                return output
-        except subprocess.CalledProcessError:
+            if CONN.isAlive():
+                return CONN
+        except libvirt.libvirtError:
             pass
-        count = count - 1
-        time.sleep(1)
-
-
-# lock this whole thing for now
-def _copy_image(config, source, instance, size):
-    # we only want this in the child so create it there
-    CACHED_SESSION = cachecontrol.CacheControl(
-        requests.Session(),
-        cache=file_cache.FileCache('.web_cache'),
-        serializer=MySerializer())
-    _print('%s waiting for image lock' % instance)
-    with LOCK:
-        _print('%s acquired for lock' % instance)
-        # source is expected to be a url
-        source_file = source.rsplit('/', 1)[1]
+        _print('reconnecting to libvirt')
         try:
-            os.unlink(source_file)
-        except FileNotFoundError:
+            CONN.close()
+        except libvirt.libvirtError:
             pass
-        _print('Fetching image from %s' % source)
-        source_refresh = CACHED_SESSION.get(source, stream=True)
-        _print('Writing source image %s' % source_file)
-        with open(source_file, 'wb') as sf:
-            shutil.copyfileobj(source_refresh.raw, sf)
-
-        _print('Creating instance image %s' % source_file)
-        # Getting the image is separate from resizing.
-        dest = '%s.img' % instance
-        # FIXME: error handling
-        # FIXME: we can't assume the filesystem, but for now we do.
-        env = {
-            # Needed on some esxi hosts.
-            'LIBGUESTFS_BACKEND_SETTINGS': 'force_tcg',
-        }
-        if config['resize']:
+    CONN = libvirt.open('qemu:///system')
+    return CONN
+
+
+def _domain_xml(config, instance, memory, vcpu, disk, disk_format,
+                pinning=None):
+    """Describe a domain like the one virt-install --import would make.
+
+    pinning, if given, has the NUMA node and its cpus to keep the
+    domain on, and the size of hugepages to back its memory with.
+    """
+    domain = ElementTree.Element('domain', type=config['domain_type'])
+    ElementTree.SubElement(domain, 'name').text = instance
+    ElementTree.SubElement(domain, 'uuid').text = instance
+    ElementTree.SubElement(domain, 'memory', unit='MiB').text = str(memory)
+    if pinning:
+        ElementTree.SubElement(
+            domain, 'vcpu', placement='static',
+            cpuset=numa.cpuset(pinning['cpus'])).text = str(vcpu)
+        numatune = ElementTree.SubElement(domain, 'numatune')
+        ElementTree.SubElement(numatune, 'memory', mode='strict',
+                               nodeset=str(pinning['node']))
+        if pinning['hugepage_kb']:
+            backing = ElementTree.SubElement(domain, 'memoryBacking')
+            hugepages = ElementTree.SubElement(backing, 'hugepages')
+            ElementTree.SubElement(hugepages, 'page',
+                                   size=str(pinning['hugepage_kb']),
+                                   unit='KiB')
+    else:
+        ElementTree.SubElement(domain, 'vcpu').text = str(vcpu)
+    os_element = ElementTree.SubElement(domain, 'os')
+    ElementTree.SubElement(
+        os_element, 'type', arch=os.uname().machine).text = 'hvm'
+    ElementTree.SubElement(os_element, 'boot', dev='hd')
+    features = ElementTree.SubElement(domain, 'features')
+    ElementTree.SubElement(features, 'acpi')
+    ElementTree.SubElement(features, 'apic')
+    if config['domain_type'] == 'kvm':
+        ElementTree.SubElement(domain, 'cpu', mode='host-model')
+    ElementTree.SubElement(domain, 'clock', offset='utc')
+    devices = ElementTree.SubElement(domain, 'devices')
+    disk_element = ElementTree.SubElement(
+        devices, 'disk', type='file', device='disk')
+    ElementTree.SubElement(
+        disk_element, 'driver', name='qemu', type=disk_format)
+    ElementTree.SubElement(
+        disk_element, 'source', file=os.path.abspath(disk))
+    ElementTree.SubElement(disk_element, 'target', dev='vda', bus='virtio')
+    interfaces = [('network', {'network': config['network']})]
+    if config['bridge']:
+        interfaces.append(('bridge', {'bridge': config['bridge']}))
+    for interface_type, source in interfaces:
+        interface = ElementTree.SubElement(
+            devices, 'interface', type=interface_type)
+        ElementTree.SubElement(interface, 'source', **source)
+        ElementTree.SubElement(interface, 'model', type='virtio')
+    serial = ElementTree.SubElement(devices, 'serial', type='pty')
+    ElementTree.SubElement(serial, 'target', port='0')
+    console = ElementTree.SubElement(devices, 'console', type='pty')
+    ElementTree.SubElement(console, 'target', type='serial', port='0')
+    return ElementTree.tostring(domain, encoding='unicode')
+
+
+def _start_domain(config, data):
+    """The start stage: define and start the instance.
+
+    Returns True if it started (the parent then waits for its IP) and
+    None if it did not.
+    """
+    instance = data['instance']
+    allocations = _resources(data)
+    _print(allocations)
+    pinning = None
+    if config['numa']:
+        node = numa.node_for(config['uuid'], data['allocations'])
+        if node is not None:
+            pinning = {'node': node, 'cpus': numa.nodes()[node]['cpus'],
+                       'hugepage_kb': config['hugepage_kb'], 'hugepages': 0}
+    xml = _domain_xml(config, instance, allocations['MEMORY_MB'],
+                      allocations['VCPU'], data['disk'],
+                      data['disk_format'], pinning)
+    _print('spawning %s' % instance)
+    dom = None
+    try:
+        if pinning:
+            if pinning['hugepage_kb']:
+                pinning['hugepages'] = numa.reserve_hugepages(
+                    config['numa_state'], pinning['node'],
+                    pinning['hugepage_kb'], allocations['MEMORY_MB'])
+            numa.record(config['numa_state'], instance, pinning)
+        dom = _libvirt().defineXML(xml)
+        dom.create()
+    except (libvirt.libvirtError, OSError) as exc:
+        _print('failed to spawn %s: %s' % (instance, exc))
+        _abandon(config, instance, dom, data['disk'])
+        return None
+    _print('spawned %s' % instance)
+    return True
+
+
+def _release(instance):
+    """Give up the allocations of an instance that will not run here.
+    Returns False if they could not be.
+    """
+    try:
+        resp = PLACEMENT.delete('/allocations/%s' % instance)
+    except Exception as exc:
+        _print('\tfailed to remove allocations for %s: %s' % (
+            instance, exc))
+        return False
+    if not resp and resp.status_code != 404:
+        _print('\tfailed to remove allocations for %s: %s' % (
+            instance, resp.text))
+        return False
+    return True
+
+
+def _start_defined(config, instance):
+    """The start stage for a domain that was defined but not started.
+
+    Returns True if it started and None if it did not.
+    """
+    dom = None
+    try:
+        dom = _libvirt().lookupByName(instance)
+        dom.create()
+    except libvirt.libvirtError as exc:
+        _print('failed to start %s: %s' % (instance, exc))
+        _abandon(config, instance, dom, storage.find(config['storage'],
+                                                     instance))
+        return None
+    _print('started %s' % instance)
+    return True
+
+
+def _abandon(config, instance, dom, disk):
+    """Clear up after an instance that failed to start: its domain,
+    if any, its disk, what it held and its allocations.
+    """
+    try:
+        if dom:
+            dom.undefine()
+        if disk:
+            os.unlink(disk)
+    except (libvirt.libvirtError, OSError) as exc:
+        _print('\tfailed to clean up %s: %s' % (instance, exc))
+    images.remove_ref(config['image_store'], instance)
+    numa.forget(config['numa_state'], instance)
+    _release(instance)
+
+
+def _destroy(config, instance):
+    """Destroy an instance and clear up after it. An instance whose
+    domain has already gone is taken to be destroyed, but its disk and
+    what it held are still cleared up.
+    """
+    conn = _libvirt()
+    try:
+        dom = conn.lookupByName(instance)
+    except libvirt.libvirtError as exc:
+        if exc.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+            raise
+        _print('\tno domain for %s' % instance)
+        dom = None
+    if dom:
+        if dom.isActive():
+            dom.destroy()
+        dom.undefine()
+    img = storage.find(config['storage'], instance)
+    if img:
+        os.unlink(img)
+    images.remove_ref(config['image_store'], instance)
+    numa.forget(config['numa_state'], instance)
+
+
+def _copy_image(config, source_file, instance, size):
+    # source_file is a blob in the store, held for instance with a ref.
+    _print('Creating instance image from %s' % source_file)
+    dest = storage.disk_path(storage.pick(config['storage'], size),
+                             instance)
+    # FIXME: we can't assume the filesystem, but for now we do.
+    env = {
+        # Needed on some esxi hosts.
+        'LIBGUESTFS_BACKEND_SETTINGS': 'force_tcg',
+    }
+    try:
+        if config['overlay']:
+            base, virtual_size = images.qcow2_base(source_file)
+            subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2',
+                                   '-F', 'qcow2',
+                                   '-b', os.path.abspath(base), dest])
+            size = size * images.GB
+            if size > virtual_size:
+                subprocess.check_call(['qemu-img', 'resize', dest,
+                                       str(size)])
+        elif config['resize']:
             subprocess.check_call(['truncate', '-r', source_file, dest])
             subprocess.check_call(['truncate', '-s', '%sG' % size, dest])
             subprocess.check_call(['virt-resize', '--expand', '/dev/sda1',
                                    source_file, dest], env=env)
         else:
-            # FIXME: this makes too many assumptions about image format
-            # subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2',
-            #                        '-b', source_file,
-            #                        dest])
-            # And this is space wasteful.
+            # This is space wasteful, see overlay.
             shutil.copyfile(source_file, dest)
+    except Exception:
+        # Leave neither half a disk nor a ref holding the image.
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dest)
+        images.remove_ref(config['image_store'], instance)
+        raise
     return dest
 
 
 def _set_inventory(session, uuid, generation, inventory):
-    """Set the inventory."""
+    """Set the inventory, retrying with a fresh generation if someone
+    else has changed the provider. Returns the new generation or None.
+    """
     url = '/resource_providers/%s/inventories' % uuid
-    data = {
-        'inventories': inventory,
-        'resource_provider_generation': generation,
-    }
-    resp = session.put(url, json=data)
-    if resp:
-        return True
-    _print('failed to set inventory')
-    sys.exit(1)
+    for attempt in range(INVENTORY_RETRIES):
+        data = {
+            'inventories': inventory,
+            'resource_provider_generation': generation,
+        }
+        resp = session.put(url, json=data)
+        if resp:
+            generation = resp.json()['resource_provider_generation']
+            current = INVENTORY.setdefault(
+                uuid, {'generation': None, 'inventories': {}})
+            current['generation'] = generation
+            current['inventories'].clear()
+            current['inventories'].update(inventory)
+            return generation
+        if resp.status_code != 409:
+            break
+        resp = session.get('/resource_providers/%s' % uuid)
+        if not resp:
+            break
+        generation = resp.json()['generation']
+    _print('failed to set inventory: %s' % resp.text)
+    return None
 
 
-def _create_resource_provider(session, uuid):
-    """Create the resource provider that this compute is."""
+def _create_resource_provider(session, uuid, parent=None):
+    """Create the resource provider that this compute, or one of its
+    NUMA nodes, is.
+    """
     url = '/resource_providers'
     data = {'uuid': uuid, 'name': uuid}
+    if parent:
+        data['parent_provider_uuid'] = parent
     resp = session.post(url, json=data)
     if resp:
         return resp.json()['generation']
@@ -383,6 +1340,7 @@ def run():
     global CONFIG, CLIENT
     config = conf.configure(CONFIG, 'compute.yaml')
     _print(config)
+    trace.configure(config['trace_file'], 'ecompute')
     if config['etcd']:
         CLIENT = etcd3.client(**config['etcd'])
     else:
@@ -0,0 +1,515 @@
+"""A local store of images, fetched by url and kept by content digest.
+
+The store is a directory with four parts:
+
+* ``blobs/<sha256>``: the image data, named by its digest, so two urls
+  serving the same bytes share one file.
+* ``index/<sha256 of url>.json``: what we know about a url: its digest,
+  size, ETag and when it was fetched.
+* ``locks/``: files used with ``flock`` so that pool workers (which are
+  separate processes) can coordinate.
+* ``refs/<sha256>/<instance>``: builds that have fetched a blob and
+  not yet made their disk from it, and instance disks that are qcow2
+  overlays backed by it. A blob with refs is never evicted.
+
+Fetching a url takes an exclusive lock on that url only, so downloads of
+different images run in parallel. Using a blob takes a shared lock on its
+digest and eviction will only remove a blob it can lock exclusively, so a
+blob is never removed while an instance disk is being made from it.
+
+Eviction is least recently used, by blob mtime, which is bumped every
+time the blob is used. A blob that is not qcow2 may have a converted
+copy, ``blobs/<sha256>.qcow2``, which is locked, referenced and evicted
+along with it.
+
+Downloads are streamed to disk in fixed size chunks, hashing as they go,
+so memory use does not depend on the size of the image. Large images
+from servers that accept ranges are fetched in several parallel ranges,
+each of which must be of the version the origin answered a HEAD with.
+If the url has a ``#sha256=<hex>`` fragment, the digest of what was
+downloaded must match it.
+
+Blobs can be served to other computes over HTTP, at ``/blobs/<sha256>``
+(see serve), and fetch will try such peers before the origin url. A
+peer's copy is only used if it is what the origin has now: the digest
+in the url fragment, or else the ETag or Last-Modified the origin
+answers a HEAD request with, must match the peer's.
+"""
+
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+from http import server
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import threading
+import time
+from urllib import parse
+
+import requests
+
+BLOBS = 'blobs'
+INDEX = 'index'
+LOCKS = 'locks'
+REFS = 'refs'
+CHUNK = 1024 * 1024
+GB = 1024 * 1024 * 1024
+# Images smaller than this are not worth splitting into ranges.
+RANGE_MIN = 256 * 1024 * 1024
+# Seconds to wait to connect, and between reads, for HEAD requests and
+# requests to peers, so that one which does not answer is given up on.
+TIMEOUT = (5, 30)
+
+
+def _key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _init(store):
+    for part in (BLOBS, INDEX, LOCKS, REFS):
+        os.makedirs(os.path.join(store, part), exist_ok=True)
+
+
+@contextlib.contextmanager
+def lock(store, name, shared=False, blocking=True):
+    """Hold a lock on name, across processes, for the duration.
+
+    Raises BlockingIOError if blocking is False and the lock is held.
+    """
+    _init(store)
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    with open(os.path.join(store, LOCKS, name), 'a') as lock_file:
+        fcntl.flock(lock_file, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def blob_path(store, digest):
+    return os.path.join(store, BLOBS, digest)
+
+
+def lookup(store, url):
+    """Return the index entry for url, if the blob is still present."""
+    index_file = os.path.join(store, INDEX, '%s.json' % _key(url))
+    try:
+        with open(index_file) as index:
+            entry = json.load(index)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not os.path.exists(blob_path(store, entry['digest'])):
+        return None
+    return entry
+
+
+def cached(store):
+    """Return the index entries of all images present in the store."""
+    entries = []
+    try:
+        names = os.listdir(os.path.join(store, INDEX))
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        try:
+            with open(os.path.join(store, INDEX, name)) as index:
+                entry = json.load(index)
+        except (FileNotFoundError, ValueError):
+            continue
+        if os.path.exists(blob_path(store, entry['digest'])):
+            entries.append(entry)
+    return entries
+
+
+def _record(store, url, entry):
+    index_file = os.path.join(store, INDEX, '%s.json' % _key(url))
+    tmp_file = '%s.%s' % (index_file, os.getpid())
+    with open(tmp_file, 'w') as index:
+        json.dump(entry, index)
+    os.rename(tmp_file, index_file)
+
+
+def _expected_digest(url):
+    """Return the sha256 named in the url fragment, if any."""
+    fragment = parse.urlsplit(url).fragment
+    return parse.parse_qs(fragment).get('sha256', [None])[0]
+
+
+def _partial(store, url):
+    return os.path.join(store, BLOBS, '%s.%s.partial' % (
+        _key(url), os.getpid()))
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as blob:
+        while True:
+            chunk = blob.read(CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stream(partial, resp):
+    """Write the body of resp to partial, returning digest and size."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(partial, 'wb') as blob:
+        for chunk in resp.iter_content(CHUNK):
+            digest.update(chunk)
+            blob.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _fetch_range(session, url, partial, start, end, etag, last_modified):
+    # With If-Range the origin sends the whole, changed, image rather
+    # than a range of it if it has changed since the HEAD.
+    headers = {'range': 'bytes=%d-%d' % (start, end),
+               'if-range': etag or last_modified}
+    resp = session.get(url, headers=headers, stream=True)
+    if resp.status_code != 206:
+        raise ValueError('range request for %s got %s' % (
+            url, resp.status_code))
+    if etag and resp.headers.get('etag') != etag:
+        raise ValueError('%s changed while being fetched' % url)
+    fd = os.open(partial, os.O_WRONLY)
+    try:
+        offset = start
+        for chunk in resp.iter_content(CHUNK):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    finally:
+        os.close(fd)
+    if offset != end + 1:
+        raise ValueError('short range for %s at %s' % (url, start))
+
+
+def _stream_ranges(partial, session, url, size, ranges, etag,
+                   last_modified):
+    """Fetch url in ranges parallel requests, returning digest and size.
+
+    Every range must be of the version with etag, or else last_modified.
+    """
+    with open(partial, 'wb') as blob:
+        blob.truncate(size)
+    step = -(-size // ranges)
+    with concurrent.futures.ThreadPoolExecutor(ranges) as executor:
+        futures = [
+            executor.submit(_fetch_range, session, url, partial,
+                            start, min(start + step, size) - 1,
+                            etag, last_modified)
+            for start in range(0, size, step)]
+        for future in futures:
+            future.result()
+    # Ranges arrive out of order, so hash once they are all written.
+    return _hash_file(partial), size
+
+
+def _download(store, url, session, resp=None, ranges=1, expected=None,
+              timeout=None):
+    """Stream url into the store, returning its index entry.
+
+    If resp is given it is a streaming response to use for the body.
+    If expected is given it is the digest the body must have, otherwise
+    the url fragment is checked. timeout is passed to the GET.
+    """
+    partial = _partial(store, url)
+    headers = {}
+    try:
+        if resp is None and ranges > 1:
+            head = session.head(url, allow_redirects=True,
+                                timeout=TIMEOUT)
+            size = int(head.headers.get('content-length', 0))
+            etag = head.headers.get('etag')
+            if etag and etag.startswith('W/'):
+                # A weak ETag cannot be used with If-Range.
+                etag = None
+            last_modified = head.headers.get('last-modified')
+            if (head and head.headers.get('accept-ranges') == 'bytes'
+                    and size >= RANGE_MIN and (etag or last_modified)):
+                headers = head.headers
+                digest, size = _stream_ranges(
+                    partial, session, url, size, ranges, etag,
+                    last_modified)
+        if not headers:
+            if resp is None:
+                resp = session.get(url, stream=True, timeout=timeout)
+            resp.raise_for_status()
+            headers = resp.headers
+            digest, size = _stream(partial, resp)
+        expected = expected or _expected_digest(url)
+        if expected and expected != digest:
+            raise ValueError('digest mismatch for %s: got %s' % (
+                url, digest))
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(partial)
+        raise
+    os.rename(partial, blob_path(store, digest))
+    return {
+        'url': url,
+        'digest': digest,
+        'size': size,
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified'),
+        'fetched': time.time(),
+    }
+
+
+def _current_peers(url, session, peers):
+    """Return the peers whose copy of url is what the origin has now,
+    and the origin's ETag and Last-Modified.
+    """
+    expected = _expected_digest(url)
+    if expected:
+        return [peer for peer in peers if peer[1] == expected], None, None
+    try:
+        head = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except Exception:
+        return [], None, None
+    etag = head.headers.get('etag') if head else None
+    last_modified = head.headers.get('last-modified') if head else None
+    if etag:
+        current = [peer for peer in peers if peer[2] == etag]
+    elif last_modified:
+        current = [peer for peer in peers if peer[3] == last_modified]
+    else:
+        # Nothing to tell a stale copy by.
+        current = []
+    return current, etag, last_modified
+
+
+def _from_peers(store, url, session, peers):
+    """Try to download url from peers, a list of (blob url, digest,
+    ETag, Last-Modified), that have what the origin has now.
+    """
+    peers, etag, last_modified = _current_peers(url, session, peers)
+    random.shuffle(peers)
+    for peer_url, digest, _, _ in peers:
+        try:
+            entry = _download(store, peer_url, session, expected=digest,
+                              timeout=TIMEOUT)
+        except Exception:
+            continue
+        entry.update({'url': url, 'etag': etag,
+                      'last_modified': last_modified, 'peer': peer_url})
+        return entry
+    return None
+
+
+def fetch(store, url, session, revalidate=False, ranges=1, peers=None):
+    """Make sure url is in the store and return its index entry.
+
+    If revalidate is True a cached image is checked with the origin
+    using its ETag or Last-Modified, and still used if the origin cannot
+    be reached or answers with an error, otherwise it is used as is. If
+    peers, a list of (blob url, digest, ETag, Last-Modified), is given
+    those with what the origin has now are tried, in random order,
+    before the origin. The entry has an extra ``hit`` key
+    saying whether the body was not downloaded.
+    """
+    _init(store)
+    with lock(store, _key(url)):
+        entry = lookup(store, url)
+        resp = None
+        if entry:
+            if not revalidate:
+                entry['hit'] = True
+                return entry
+            headers = {}
+            if entry['etag']:
+                headers['if-none-match'] = entry['etag']
+            if entry['last_modified']:
+                headers['if-modified-since'] = entry['last_modified']
+            try:
+                resp = session.get(url, headers=headers, stream=True)
+            except (requests.ConnectionError, requests.Timeout):
+                entry['hit'] = True
+                return entry
+            # Unchanged, or the origin cannot answer, in which case the
+            # copy we have is better than none.
+            if resp.status_code == 304 or not resp:
+                resp.close()
+                entry['hit'] = True
+                return entry
+            entry = None
+        elif peers:
+            entry = _from_peers(store, url, session, peers)
+        if not entry:
+            entry = _download(store, url, session, resp, ranges)
+        _record(store, url, entry)
+        entry['hit'] = False
+        return entry
+
+
+@contextlib.contextmanager
+def fetched(store, url, session, budget_gb=None, found=None, **kwargs):
+    """Fetch url and yield the path to its blob, held against eviction.
+
+    If budget_gb is set, other images are evicted once this one is
+    held. If found is a dict, it is updated with the entry fetch
+    returns. Other keyword arguments are passed to fetch.
+    """
+    while True:
+        entry = fetch(store, url, session, **kwargs)
+        if found is not None:
+            found.update(entry)
+        digest = entry['digest']
+        with lock(store, digest, shared=True):
+            path = blob_path(store, digest)
+            try:
+                # Mark as recently used.
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted between fetch and lock, go again.
+                continue
+            if budget_gb is not None:
+                evict(store, budget_gb)
+            yield path
+            return
+
+
+def evict(store, budget_gb):
+    """Remove least recently used blobs until under budget_gb.
+
+    Blobs that are in use are skipped.
+    """
+    budget = budget_gb * GB
+    blob_dir = os.path.join(store, BLOBS)
+    with lock(store, 'evict'):
+        blobs = []
+        for name in os.listdir(blob_dir):
+            if name.endswith('.partial'):
+                continue
+            try:
+                stat = os.stat(os.path.join(blob_dir, name))
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, name))
+        total = sum(blob[1] for blob in blobs)
+        for mtime, size, name in sorted(blobs):
+            if total <= budget:
+                break
+            digest = name.split('.')[0]
+            if _referenced(store, digest):
+                continue
+            try:
+                with lock(store, digest, blocking=False):
+                    os.unlink(os.path.join(blob_dir, name))
+                    total -= size
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+
+def _info(path):
+    output = subprocess.check_output(
+        ['qemu-img', 'info', '--output=json', path])
+    return json.loads(output)
+
+
+def disk_format(path):
+    """Return the format, such as raw or qcow2, of the disk at path."""
+    return _info(path)['format']
+
+
+def qcow2_base(path):
+    """Return a qcow2 version of the blob at path and its virtual size.
+
+    If the blob is not already qcow2 it is converted once and the
+    converted copy is kept next to it. The caller is expected to hold
+    the blob (see fetched).
+    """
+    info = _info(path)
+    if info['format'] == 'qcow2':
+        return path, info['virtual-size']
+    converted = '%s.qcow2' % path
+    store = os.path.dirname(os.path.dirname(path))
+    with lock(store, '%s.qcow2' % os.path.basename(path)):
+        if not os.path.exists(converted):
+            partial = '%s.%s.partial' % (converted, os.getpid())
+            try:
+                subprocess.check_call(
+                    ['qemu-img', 'convert', '-f', info['format'],
+                     '-O', 'qcow2', path, partial])
+            except Exception:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(partial)
+                raise
+            os.rename(partial, converted)
+    os.utime(converted)
+    return converted, info['virtual-size']
+
+
+def _referenced(store, digest):
+    try:
+        return bool(os.listdir(os.path.join(store, REFS, digest)))
+    except FileNotFoundError:
+        return False
+
+
+def add_ref(store, digest, instance):
+    """Record that instance has a disk backed by the blob digest."""
+    ref_dir = os.path.join(store, REFS, digest)
+    os.makedirs(ref_dir, exist_ok=True)
+    open(os.path.join(ref_dir, instance), 'w').close()
+
+
+def remove_ref(store, instance):
+    """Forget any blob that instance has a disk backed by."""
+    try:
+        digests = os.listdir(os.path.join(store, REFS))
+    except FileNotFoundError:
+        return
+    for digest in digests:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(store, REFS, digest, instance))
+
+
+class _BlobHandler(server.BaseHTTPRequestHandler):
+    """Serve blobs from the store, holding each against eviction."""
+
+    store = None
+
+    def do_GET(self):
+        match = re.match(r'^/blobs/([0-9a-f]{64})$', self.path)
+        if not match:
+            self.send_error(404)
+            return
+        digest = match.group(1)
+        with lock(self.store, digest, shared=True):
+            try:
+                blob = open(blob_path(self.store, digest), 'rb')
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+            with blob:
+                self.send_response(200)
+                self.send_header('content-type', 'application/octet-stream')
+                self.send_header('content-length',
+                                 str(os.fstat(blob.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(blob, self.wfile, CHUNK)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(store, port, address=''):
+    """Serve the blobs in store on address and port, in a background
+    thread.
+    """
+    _init(store)
+    handler = type('BlobHandler', (_BlobHandler,), {'store': store})
+    httpd = server.ThreadingHTTPServer((address, port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,120 @@
+"""Find guest IP addresses as their DHCP leases appear.
+
+One LeaseWatcher serves every booting guest on the host. It watches the
+mtime of the dnsmasq lease (or status) file for the libvirt network and,
+when it changes, asks libvirt for the network's DHCP leases once and
+matches them against the MAC addresses of the guests it is waiting on.
+"""
+
+import os
+import threading
+import time
+from xml.etree import ElementTree
+
+import libvirt
+
+# How often to stat the lease file.
+TICK = 0.25
+
+
+class LeaseWatcher(object):
+
+    def __init__(self, network, lease_file, timeout):
+        self.network = network
+        self.lease_file = lease_file
+        self.timeout = timeout
+        # instance: [mac, deadline, callback]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.nudge = threading.Event()
+        self.conn = None
+        self.mtime = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def wait(self, instance, callback):
+        """Call callback with the IP of instance once it has one, or
+        with None after timeout.
+        """
+        with self.lock:
+            self.pending[instance] = [None, time.time() + self.timeout,
+                                      callback]
+        self.nudge.set()
+
+    def _connection(self):
+        if self.conn is None or not self.conn.isAlive():
+            self.conn = libvirt.open('qemu:///system')
+        return self.conn
+
+    def _mac(self, instance):
+        """Return the MAC of the instance's interface on our network."""
+        try:
+            dom = self._connection().lookupByName(instance)
+        except libvirt.libvirtError:
+            # Not defined yet.
+            return None
+        xml = ElementTree.fromstring(dom.XMLDesc(0))
+        for iface in xml.findall('./devices/interface'):
+            source = iface.find('source')
+            mac = iface.find('mac')
+            if (source is not None and mac is not None
+                    and source.get('network') == self.network):
+                return mac.get('address').lower()
+        return None
+
+    def _leases(self):
+        network = self._connection().networkLookupByName(self.network)
+        return {lease['mac'].lower(): lease['ipaddr']
+                for lease in network.DHCPLeases()
+                if lease['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4}
+
+    def _changed(self):
+        try:
+            mtime = os.stat(self.lease_file).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        changed = mtime != self.mtime
+        self.mtime = mtime
+        return changed
+
+    def _resolve(self):
+        with self.lock:
+            pending = dict(self.pending)
+        for instance, waiting in pending.items():
+            if waiting[0] is None:
+                waiting[0] = self._mac(instance)
+        leases = self._leases()
+        now = time.time()
+        for instance, (mac, deadline, callback) in pending.items():
+            ip_address = leases.get(mac)
+            if ip_address or now > deadline:
+                with self.lock:
+                    self.pending.pop(instance, None)
+                try:
+                    callback(ip_address)
+                except Exception as exc:
+                    # Keep on watching for the other guests.
+                    print('lease callback for %s saw %s' % (instance, exc))
+
+    def _run(self):
+        checked = 0
+        while True:
+            nudged = self.nudge.wait(TICK)
+            self.nudge.clear()
+            if not self.pending:
+                continue
+            # A lease may already be there for a new guest, so look
+            # when nudged as well as when the file changes. Look at
+            # least once a second to notice timeouts.
+            now = time.time()
+            if nudged or self._changed() or now - checked >= 1:
+                checked = now
+                try:
+                    self._resolve()
+                except libvirt.libvirtError as exc:
+                    print('lease watcher saw %s' % exc)
+                    self.conn = None
+                except Exception as exc:
+                    print('lease watcher saw %s' % exc)
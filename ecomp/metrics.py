@@ -0,0 +1,204 @@
+"""Counts and timings of builds, served in the Prometheus text format.
+
+Metrics are only kept in the ecompute parent process, where the stage
+callbacks run. Each build is timed through its phases: fetch (getting
+the image), prepare (making the instance disk), start (defining and
+starting the domain) and ip (waiting for the guest's DHCP lease). A
+phase runs from the end of the one before, so it includes the time the
+build waited in the stage's queue, which the stages also time on their
+own (see ecomp.pipeline).
+
+Histograms have fixed buckets, in seconds. Gauges, such as queue
+depths, are read when the metrics are served.
+"""
+
+import collections
+from http import server
+import threading
+import time
+
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500)
+PHASES = ('fetch', 'prepare', 'start', 'ip')
+LOCK = threading.Lock()
+# (name, labels): Histogram
+HISTOGRAMS = {}
+# (name, labels): count
+COUNTERS = collections.Counter()
+# The builds being timed, by instance: {'start': t, 'last': t, 'phases'}
+BUILDS = {}
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Add value to the histogram name with labels."""
+    with LOCK:
+        key = (name, _labels(labels))
+        if key not in HISTOGRAMS:
+            HISTOGRAMS[key] = Histogram()
+        HISTOGRAMS[key].observe(value)
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to the counter name with labels."""
+    with LOCK:
+        COUNTERS[(name, _labels(labels))] += amount
+
+
+def start(instance):
+    """Start timing the build of instance."""
+    now = time.time()
+    with LOCK:
+        BUILDS[instance] = {'start': now, 'last': now, 'phases': {}}
+
+
+def phase(instance, name):
+    """Say that instance has finished the phase name."""
+    now = time.time()
+    with LOCK:
+        build = BUILDS.get(instance)
+        if build is None:
+            return
+        elapsed = now - build['last']
+        build['last'] = now
+        build['phases'][name] = elapsed
+    observe('ecompute_build_phase_seconds', elapsed, phase=name)
+
+
+def finish(instance, outcome):
+    """Stop timing the build of instance, which ended with outcome
+    ('booted', 'no_ip' or 'failed'). Returns its phases and total, or
+    None if it was not being timed.
+    """
+    with LOCK:
+        build = BUILDS.pop(instance, None)
+    if build is None:
+        return None
+    inc('ecompute_builds_total', outcome=outcome)
+    timings = dict(build['phases'])
+    timings['total'] = time.time() - build['start']
+    if outcome == 'booted':
+        observe('ecompute_build_seconds', timings['total'])
+    return timings
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in labels)
+
+
+def render(gauges=None):
+    """Return all metrics, and the gauges (a dict of (name, labels):
+    value), in the Prometheus text format.
+    """
+    lines = []
+    with LOCK:
+        counters = sorted(COUNTERS.items())
+        histograms = sorted(
+            (key, list(histogram.counts), histogram.count, histogram.sum)
+            for key, histogram in HISTOGRAMS.items())
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    for (name, labels), counts, count, total in histograms:
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE %s histogram' % name)
+        for bound, bucket in zip(BUCKETS, counts):
+            lines.append('%s_bucket%s %s' % (
+                name, _format_labels(labels, [('le', bound)]), bucket))
+        lines.append('%s_bucket%s %s' % (
+            name, _format_labels(labels, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %s' % (name, _format_labels(labels),
+                                        count))
+    for (name, labels), value in sorted((gauges or {}).items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE %s gauge' % name)
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """Return a compact summary: the count and mean seconds of each
+    phase, and of whole builds, and the image cache hit ratio.
+    """
+    with LOCK:
+        histograms = {(name, labels): (histogram.count, histogram.sum)
+                      for (name, labels), histogram in HISTOGRAMS.items()}
+        hits = COUNTERS[('ecompute_image_cache_total',
+                         (('result', 'hit'),))]
+        misses = COUNTERS[('ecompute_image_cache_total',
+                           (('result', 'miss'),))]
+    timings = {}
+    for phase_name in PHASES:
+        count, total = histograms.get(
+            ('ecompute_build_phase_seconds', (('phase', phase_name),)),
+            (0, 0))
+        timings[phase_name] = [count, round(total / count, 2) if count else 0]
+    count, total = histograms.get(('ecompute_build_seconds', ()), (0, 0))
+    timings['total'] = [count, round(total / count, 2) if count else 0]
+    return {
+        'timings': timings,
+        'image_hit_ratio': round(hits / (hits + misses), 3)
+        if hits + misses else None,
+        'time': time.time(),
+    }
+
+
+class _MetricsHandler(server.BaseHTTPRequestHandler):
+
+    gauges = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render(self.gauges()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('content-type', 'text/plain; version=0.0.4')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, gauges, address=''):
+    """Serve metrics at /metrics on address and port, in a background
+    thread.
+
+    gauges is called for each request and returns the gauges, as for
+    render.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   {'gauges': staticmethod(gauges)})
+    httpd = server.ThreadingHTTPServer((address, port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,152 @@
+"""Host NUMA topology, and keeping a guest on one NUMA node.
+
+With numa set, ecompute reports each NUMA node of the host as a child
+resource provider of the compute, holding the node's VCPU and MEMORY_MB,
+while the compute itself keeps DISK_GB. eschedule asks for VCPU and
+MEMORY_MB from one provider, so an allocation names the node a guest is
+to run on. The guest's vCPUs are pinned to the node's cpus and its
+memory to the node's memory.
+
+Guest memory may be backed by hugepages, added to the node's pool when
+the guest starts and taken away when it is destroyed. What was taken is
+recorded in ``<state>/<instance>.json`` so it is given back correctly
+even if the configuration has changed since.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import re
+import uuid
+
+NODE_DIR = '/sys/devices/system/node'
+
+
+def _cpulist(text):
+    """Turn a sysfs cpu list, such as '0-3,8-11', into a list of cpus."""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def cpuset(cpus):
+    """Turn a list of cpus into a libvirt cpuset."""
+    return ','.join(str(cpu) for cpu in cpus)
+
+
+def nodes():
+    """Return the NUMA nodes that have cpus, as
+    {node: {'cpus': [...], 'memory_mb': int}}.
+    """
+    topology = {}
+    for name in os.listdir(NODE_DIR):
+        if not re.match(r'node\d+$', name):
+            continue
+        path = os.path.join(NODE_DIR, name)
+        with open(os.path.join(path, 'cpulist')) as cpulist:
+            cpus = _cpulist(cpulist.read())
+        memory_mb = 0
+        with open(os.path.join(path, 'meminfo')) as meminfo:
+            for line in meminfo:
+                # Node 0 MemTotal:       32658332 kB
+                fields = line.split()
+                if fields[2] == 'MemTotal:':
+                    memory_mb = int(fields[3]) // 1024
+        if cpus:
+            topology[int(name[4:])] = {'cpus': cpus, 'memory_mb': memory_mb}
+    return topology
+
+
+def provider_uuid(compute_uuid, node):
+    """Return the uuid of the resource provider for a node."""
+    return str(uuid.uuid5(uuid.UUID(compute_uuid), 'numa%d' % node))
+
+
+def node_for(compute_uuid, allocations):
+    """Return the node allocations are on, or None if they are not on
+    any.
+    """
+    for node in nodes():
+        if provider_uuid(compute_uuid, node) in allocations:
+            return node
+    return None
+
+
+def _pool_file(node, hugepage_kb):
+    return os.path.join(NODE_DIR, 'node%d' % node, 'hugepages',
+                        'hugepages-%dkB' % hugepage_kb, 'nr_hugepages')
+
+
+@contextlib.contextmanager
+def _pool_lock(state):
+    """Hold the hugepage pools, locked across processes."""
+    os.makedirs(state, exist_ok=True)
+    with open(os.path.join(state, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _pool_size(node, hugepage_kb, pages=None):
+    """Return the size of the node's pool, after setting it to pages if
+    that is not None.
+    """
+    path = _pool_file(node, hugepage_kb)
+    if pages is not None:
+        with open(path, 'w') as pool:
+            pool.write('%d\n' % pages)
+    with open(path) as pool:
+        return int(pool.read())
+
+
+def reserve_hugepages(state, node, hugepage_kb, memory_mb):
+    """Grow the node's pool by enough hugepages for memory_mb and
+    return how many were added.
+
+    Raises OSError if the kernel could not find them all.
+    """
+    pages = -(-memory_mb * 1024 // hugepage_kb)
+    with _pool_lock(state):
+        total = _pool_size(node, hugepage_kb)
+        if _pool_size(node, hugepage_kb, total + pages) < total + pages:
+            _pool_size(node, hugepage_kb, total)
+            raise OSError('node %d has no room for %d hugepages of %dkB' % (
+                node, pages, hugepage_kb))
+    return pages
+
+
+def release_hugepages(state, node, hugepage_kb, pages):
+    """Shrink the node's pool by pages."""
+    with _pool_lock(state):
+        total = _pool_size(node, hugepage_kb)
+        _pool_size(node, hugepage_kb, max(total - pages, 0))
+
+
+def _state_file(state, instance):
+    return os.path.join(state, '%s.json' % instance)
+
+
+def record(state, instance, pinning):
+    """Record the node and hugepages of instance."""
+    os.makedirs(state, exist_ok=True)
+    with open(_state_file(state, instance), 'w') as state_file:
+        json.dump(pinning, state_file)
+
+
+def forget(state, instance):
+    """Give back the hugepages of instance, if it has any, and forget
+    about it.
+    """
+    try:
+        with open(_state_file(state, instance)) as state_file:
+            pinning = json.load(state_file)
+    except FileNotFoundError:
+        return
+    if pinning.get('hugepages'):
+        release_hugepages(state, pinning['node'], pinning['hugepage_kb'],
+                          pinning['hugepages'])
+    os.unlink(_state_file(state, instance))
@@ -0,0 +1,190 @@
+"""Stages of work, each a pool with its own concurrency and queue.
+
+A build passes through several stages: fetching the image (network
+bound), preparing the instance disk (disk and cpu bound), starting the
+domain, waiting for the guest's IP (see ecomp.leases) and reporting to
+etcd. Giving each stage its own workers means a slow download does not
+hold a slot a disk resize could use, and the stages overlap.
+
+Each stage has a bounded queue in front of its pool. A dispatcher
+thread hands work to the pool only when a worker is free, so submit
+blocks when the queue is full, pushing back on whoever is feeding the
+stage. Callbacks run in the pool's result thread, usually to submit the
+result to the next stage. A callback that submits to its own stage is
+never blocked, as no other callback of the stage could run, and so free
+a place in the queue, until it returned.
+
+A pool quietly replaces a worker process that dies, and the task it was
+running never calls back. Workers say which task they have started, so
+a task whose worker has gone is failed, and its slot freed, instead of
+holding the stage up for good.
+
+Each stage times how long tasks wait in its queue and how long they
+then take to run, see ecomp.metrics, and adds both to the trace of the
+instance a task is for, see ecomp.trace.
+"""
+
+import itertools
+import multiprocessing
+from multiprocessing import pool as mp_pool
+import os
+import queue
+import threading
+import time
+
+from ecomp import metrics
+from ecomp import trace
+
+# How often, in seconds, to look for tasks whose worker has died.
+LOST_INTERVAL = 5
+# In a worker process, where to say which task it has started.
+STARTED = {'queue': None}
+
+
+def _init_worker(started, initializer, initargs):
+    STARTED['queue'] = started
+    if initializer:
+        initializer(*initargs)
+
+
+def _run(task, func, args):
+    """Run func(*args) in a worker, saying first that it has task."""
+    if STARTED['queue'] is not None:
+        STARTED['queue'].put((task, os.getpid()))
+    return func(*args)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class Stage(object):
+
+    def __init__(self, name, workers, queue_size, initializer=None,
+                 initargs=(), threads=False):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue()
+        # Places in the queue, taken by submit and given back as tasks
+        # are dispatched. See _in_callback.
+        self.places = threading.BoundedSemaphore(queue_size)
+        self.local = threading.local()
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tasks = itertools.count()
+        # Tasks handed to the pool: {task: [pid, error callback, suspect]}
+        self.running = {}
+        if threads:
+            self.pool = mp_pool.ThreadPool(workers, initializer, initargs)
+        else:
+            self.started = multiprocessing.SimpleQueue()
+            self.pool = multiprocessing.Pool(
+                workers, _init_worker,
+                (self.started, initializer, initargs))
+            for target in (self._record_started, self._find_lost):
+                threading.Thread(target=target, daemon=True).start()
+        thread = threading.Thread(target=self._dispatch, daemon=True)
+        thread.start()
+
+    def submit(self, func, args, callback=None, error_callback=None,
+               instance=None):
+        """Queue func(*args), for instance if given, to run, blocking if
+        the queue is full, unless called from one of our callbacks.
+        """
+        placed = not self._in_callback()
+        if placed:
+            self.places.acquire()
+        self.queue.put((func, args, callback, error_callback, instance,
+                        time.time(), placed))
+
+    def _in_callback(self):
+        return getattr(self.local, 'in_callback', False)
+
+    def depth(self):
+        """How many tasks are waiting or running."""
+        return self.queue.qsize() + self.in_flight
+
+    def close(self):
+        self.pool.terminate()
+
+    def _dispatch(self):
+        while True:
+            (func, args, callback, error_callback, instance,
+             queued, placed) = self.queue.get()
+            if placed:
+                self.places.release()
+            self.slots.acquire()
+            with self.lock:
+                self.in_flight += 1
+            started = time.time()
+            metrics.observe('ecompute_stage_wait_seconds', started - queued,
+                            stage=self.name)
+            timing = (instance, queued, started)
+            task = next(self.tasks)
+            failed = self._done(task, error_callback, timing)
+            with self.lock:
+                self.running[task] = [None, failed, False]
+            self.pool.apply_async(_run, (task, func, args), {},
+                                  self._done(task, callback, timing),
+                                  failed)
+
+    def _record_started(self):
+        while True:
+            task, pid = self.started.get()
+            with self.lock:
+                if task in self.running:
+                    self.running[task][0] = pid
+
+    def _find_lost(self):
+        """Fail tasks whose worker has died. A worker that has only just
+        died may have sent its result first, so a task is failed only
+        if its worker is gone two times in a row.
+        """
+        while True:
+            time.sleep(LOST_INTERVAL)
+            lost = []
+            with self.lock:
+                for task, running in self.running.items():
+                    pid, failed, suspect = running
+                    if pid is None or _alive(pid):
+                        running[2] = False
+                    elif suspect:
+                        lost.append((task, pid, failed))
+                    else:
+                        running[2] = True
+            for task, pid, failed in lost:
+                failed(RuntimeError('worker %s of the %s stage died' % (
+                    pid, self.name)))
+
+    def _done(self, task, callback, timing):
+        instance, queued, started = timing
+
+        def _callback(result):
+            # This runs in the pool's result thread, so free the slot
+            # first and do not let anything after it raise.
+            finished = time.time()
+            with self.lock:
+                if self.running.pop(task, None) is None:
+                    # Already failed as lost.
+                    return
+                self.in_flight -= 1
+            self.slots.release()
+            try:
+                metrics.observe('ecompute_stage_run_seconds',
+                                finished - started, stage=self.name)
+                if instance:
+                    trace.stage(instance, self.name, queued, started,
+                                finished)
+                if callback:
+                    self.local.in_callback = True
+                    callback(result)
+            except Exception as exc:
+                print('%s stage callback saw %s' % (self.name, exc))
+            finally:
+                self.local.in_callback = False
+        return _callback
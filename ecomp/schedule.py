@@ -1,36 +1,210 @@
+import collections
+import concurrent.futures
 import copy
+import hashlib
 import json
+import random
 import sys
+import threading
+import time
 import uuid
+from urllib import parse
 
 import etcd3
+import yaml
 
 from ecomp import conf
 from ecomp import clients
+from ecomp import trace
 
 # Replace with service catalog, but since right now we haven't
 # got one, raw.
 PREFIX = '/hosts'
+IMAGES_PREFIX = '/images'
+REQUESTS_PREFIX = '/requests'
+BOOTED_PREFIX = '/booted'
+# The user-data and meta-data of each instance, for the metadata server.
+INSTANCES_PREFIX = '/instances'
+# Running computes keep a key here, see _live_hosts.
+ALIVE_PREFIX = '/alive'
+# And a summary of their load here.
+LOAD_PREFIX = '/load'
+# How long, in seconds, `eschedule wait` waits by default.
+WAIT_TIMEOUT = 300
 IMAGE = 'http://download.cirros-cloud.net/0.3.6/cirros-0.3.6-x86_64-disk.img'
 CLIENT = None
 
+# etcd refuses transactions with more operations than this, by default.
+MAX_TXN_OPS = 128
+# Resource classes asked for from one provider, see _candidates_url.
+GROUPED = ('VCPU', 'MEMORY_MB')
+# The computes last seen alive, and when.
+LIVE = {'hosts': set(), 'read_at': 0}
+LIVE_LOCK = threading.Lock()
+
 # default config
 CONFIG = {
     'placement': {
         'endpoint': 'http://localhost:8080',
     },
     'etcd': {},
+    # How many claims a batch makes at once.
+    'batch_workers': 16,
+    # How to order allocation candidates before claiming them, one of
+    # the names in WEIGHERS, and how many of the best to pick from at
+    # random when it is 'random'.
+    'weigher': 'random',
+    'weigher_top_k': 5,
+    # How many requests `eschedule daemon` works on at once, and how
+    # many seconds each result is kept for, once the request it answers
+    # has been deleted. None to keep results until callers delete them.
+    'daemon_workers': 32,
+    'result_ttl': 3600,
+    # Only claim on computes that are alive and not busy, as read from
+    # etcd at most this many seconds ago. Set to None to claim on any.
+    'live_cache_seconds': 5,
+    # Append the spans of each instance scheduled to this file, None to
+    # not. The trace is carried on by ecompute. See ecomp.trace.
+    'trace_file': None,
+}
+
+
+def _free(allocation, provider_summaries):
+    """Return the fraction of capacity that would be left on the
+    providers in allocation, averaged over the resources it uses.
+    """
+    fractions = []
+    for provider, resources in allocation['allocations'].items():
+        summary = provider_summaries[provider]['resources']
+        for resource_class, amount in resources['resources'].items():
+            capacity = summary[resource_class]['capacity']
+            used = summary[resource_class]['used']
+            if capacity:
+                fractions.append((capacity - used - amount) / capacity)
+            else:
+                fractions.append(0)
+    return sum(fractions) / len(fractions) if fractions else 0
+
+
+def weigh_pack(config, allocation_requests, provider_summaries):
+    """Fullest providers first, to keep others empty."""
+    return sorted(allocation_requests,
+                  key=lambda allocation: _free(allocation,
+                                               provider_summaries))
+
+
+def weigh_spread(config, allocation_requests, provider_summaries):
+    """Emptiest providers first, to balance load."""
+    return list(reversed(weigh_pack(config, allocation_requests,
+                                    provider_summaries)))
+
+
+def weigh_random(config, allocation_requests, provider_summaries):
+    """Emptiest providers first, but with the best top_k shuffled so
+    that concurrent schedulers do not all claim the same one.
+    """
+    ordered = weigh_spread(config, allocation_requests, provider_summaries)
+    top_k = config['weigher_top_k']
+    best = ordered[:top_k]
+    random.shuffle(best)
+    return best + ordered[top_k:]
+
+
+WEIGHERS = {
+    'pack': weigh_pack,
+    'spread': weigh_spread,
+    'random': weigh_random,
 }
 
 
-def schedule(session, resources, image):
+def _live_hosts(config):
+    """Return the uuids of computes that are alive and not busy, from a
+    cached read of ALIVE_PREFIX and LOAD_PREFIX.
+    """
+    with LIVE_LOCK:
+        now = time.time()
+        if now - LIVE['read_at'] > config['live_cache_seconds']:
+            prefix = ALIVE_PREFIX + '/'
+            alive = {
+                str(meta.key, 'utf-8')[len(prefix):]
+                for _, meta in CLIENT.get_prefix(prefix, keys_only=True)}
+            prefix = LOAD_PREFIX + '/'
+            busy = {
+                str(meta.key, 'utf-8')[len(prefix):]
+                for value, meta in CLIENT.get_prefix(prefix)
+                if json.loads(value).get('busy')}
+            LIVE['hosts'] = alive - busy
+            LIVE['read_at'] = now
+        return LIVE['hosts']
+
+
+def _candidates_url(resources):
+    """Return the allocation candidates url for a resources query.
+
+    The GROUPED resources are asked for as one request group, so they
+    come from one provider: the compute, or one of its NUMA nodes if it
+    reports them per node. Queries that already use request groups are
+    left alone.
+    """
+    params = parse.parse_qsl(resources)
+    if any(name != 'resources' and name.startswith('resources')
+           for name, value in params):
+        return '/allocation_candidates?%s' % resources
+    query = []
+    for name, value in params:
+        if name != 'resources':
+            query.append((name, value))
+            continue
+        amounts = value.split(',')
+        grouped = [amount for amount in amounts
+                   if amount.split(':')[0] in GROUPED]
+        rest = [amount for amount in amounts if amount not in grouped]
+        if grouped:
+            query.append(('resources1', ','.join(grouped)))
+        if rest:
+            query.append(('resources', ','.join(rest)))
+    return '/allocation_candidates?%s' % parse.urlencode(query, safe=',:')
+
+
+def _target(allocation):
+    """Return the compute an allocation request is for, as found by
+    _weigh.
+    """
+    return allocation['target']
+
+
+def _weigh(config, data):
+    """Return the allocation requests in data in the order to try them,
+    leaving out any on computes that are not alive.
+    """
+    allocation_requests = data['allocation_requests']
+    summaries = data['provider_summaries']
+    for allocation in allocation_requests:
+        # Allocations on a child provider, such as a NUMA node, are for
+        # the compute at its root.
+        provider = list(allocation['allocations'].keys())[0]
+        allocation['target'] = summaries[provider].get(
+            'root_provider_uuid', provider)
+    if config['live_cache_seconds'] is not None:
+        live = _live_hosts(config)
+        allocation_requests = [
+            allocation for allocation in allocation_requests
+            if _target(allocation) in live]
+    weigher = WEIGHERS[config['weigher']]
+    return weigher(config, allocation_requests, data['provider_summaries'])
+
+
+def schedule(session, config, resources, image, metadata=None):
     """Given resources, find some hosts."""
     print(resources)
-    url = '/allocation_candidates?%s' % resources
+    context = trace.start()
+    url = _candidates_url(resources)
     resp = session.get(url)
     data = resp.json()
+    trace.span('candidates', context, context['start'], time.time())
     if resp:
-        success = _schedule(session, data, image)
+        success = _schedule(session, config, data, image, metadata,
+                            context)
         if not success:
             print('FAIL: no allocation available')
             sys.exit(1)
@@ -44,17 +218,28 @@ def destroy(session, instance):
     resp = session.get('/allocations/%s' % instance)
     if resp:
         current_allocations = resp.json()
-        # In this system we only have one resource provider in the allocations.
-        target = list(current_allocations['allocations'].keys())[0]
+        # The allocations are on the compute, and maybe one of its
+        # NUMA nodes, so any provider leads to the compute at the root.
+        provider = list(current_allocations['allocations'].keys())[0]
+        resp = session.get('/resource_providers/%s' % provider)
+        target = resp.json()['root_provider_uuid'] if resp else provider
         current_allocations['allocations'] = {}
         current_allocations['instance'] = instance
         current_allocations['image'] = None
         CLIENT.put('%s/%s/%s' % (PREFIX, target, instance),
                    json.dumps(current_allocations))
+        CLIENT.delete('%s/%s/metadata' % (INSTANCES_PREFIX, instance))
     else:
         print('FAILED to find allocations for %s' % instance)
 
 
+def warm(image):
+    """Ask every compute to prefetch an image, ahead of use."""
+    key = hashlib.sha256(image.encode('utf-8')).hexdigest()
+    CLIENT.put('%s/%s' % (IMAGES_PREFIX, key), image)
+    print('WARMING %s' % image)
+
+
 def query(instance):
     """Get info about an instance from etcd."""
     info, meta = CLIENT.get('/booted/%s' % instance)
@@ -66,26 +251,129 @@ def query(instance):
         sys.exit(1)
 
 
+def _booted():
+    """Return the IPs of all booted instances, with one range read, and
+    the revision they were read at.
+    """
+    prefix = BOOTED_PREFIX + '/'
+    response = CLIENT.get_prefix_response(prefix)
+    booted = {kv.key.decode('utf-8')[len(prefix):]: kv.value.decode('utf-8')
+              for kv in response.kvs}
+    return booted, response.header.revision
+
+
+def query_many(instances):
+    """Print the IP of each of instances, or of all booted instances if
+    instances is empty. Exit 1 if any have no IP.
+    """
+    booted, _ = _booted()
+    if not instances:
+        instances = sorted(booted)
+    missing = False
+    for instance in instances:
+        ip_address = booted.get(instance)
+        if not ip_address:
+            missing = True
+        print('%s %s' % (instance, ip_address or '-'))
+    sys.exit(1 if missing else 0)
+
+
+def wait(instances, timeout=WAIT_TIMEOUT):
+    """Print each of instances with its IP as soon as it has one.
+
+    Uses one read of what has already booted and one watch for the rest.
+    Exit 1 if some have no IP after timeout seconds.
+    """
+    waiting = set(instances)
+    booted, revision = _booted()
+    for instance in sorted(waiting & set(booted)):
+        print('%s %s' % (instance, booted[instance]))
+        waiting.remove(instance)
+    if waiting:
+        events_iterator, cancel = CLIENT.watch_prefix(
+            BOOTED_PREFIX + '/', start_revision=revision + 1)
+        timer = threading.Timer(timeout, cancel)
+        timer.start()
+        for event in events_iterator:
+            if not isinstance(event, etcd3.events.PutEvent):
+                continue
+            instance = event.key.decode('utf-8').rsplit('/', 1)[1]
+            if instance in waiting:
+                print('%s %s' % (instance, event.value.decode('utf-8')))
+                waiting.remove(instance)
+                if not waiting:
+                    break
+        timer.cancel()
+        cancel()
+    for instance in sorted(waiting):
+        print('%s -' % instance)
+    sys.exit(1 if waiting else 0)
+
+
+def _metadata_args(args):
+    """Take ``--user-data <file>`` and any ``--meta <key>=<value>`` out
+    of args. Returns the metadata for the instances being scheduled, or
+    None, and the rest of args.
+    """
+    metadata = {}
+    rest = []
+    args = iter(args)
+    for arg in args:
+        if arg == '--user-data':
+            with open(next(args)) as user_data:
+                metadata['user-data'] = user_data.read()
+        elif arg == '--meta':
+            key, _, value = next(args).partition('=')
+            metadata.setdefault('meta-data', {})[key] = value
+        else:
+            rest.append(arg)
+    return metadata or None, rest
+
+
 def main(config, args):
     """Establish session and call schedule."""
     # FIXME: do some real arg process
-    session = clients.PrefixedSession(
-        prefix_url=config['placement']['endpoint'])
-    session.headers.update({'x-auth-token': 'admin',
-                            'openstack-api-version': 'placement latest',
-                            'accept': 'application/json',
-                            'content-type': 'application/json'})
+    metadata, args = _metadata_args(args)
+    pool_size = max(config['batch_workers'], config['daemon_workers'])
+    session = clients.placement_session(config['placement']['endpoint'],
+                                        pool_size=pool_size)
     if args:
-        if 'resources' in args[0]:
+        if args[0] == 'daemon':
+            daemon(session, config)
+        elif args[0] == 'request':
+            try:
+                image = args[2]
+            except IndexError:
+                image = IMAGE
+            request(args[1], image, metadata)
+        elif args[0] == 'query':
+            query_many([arg for arg in args[1:] if arg != '--all'])
+        elif args[0] == 'wait':
+            timeout = WAIT_TIMEOUT
+            if len(args) > 2 and args[1] == '--timeout':
+                timeout = float(args[2])
+                args = args[2:]
+            wait(args[1:], timeout)
+        elif args[0] == 'batch':
+            if len(args) < 2 or (args[1].isdigit() and len(args) < 3):
+                print('Usage: eschedule batch <count> <resources> [image]'
+                      ' or eschedule batch <manifest>')
+                sys.exit(1)
+            if not batch(session, config,
+                         _batch_wanted(args[1:], metadata)):
+                sys.exit(1)
+        elif 'resources' in args[0]:
             try:
                 image = args[1]
             except IndexError:
                 image = IMAGE
-            schedule(session, args[0], image)
+            schedule(session, config, args[0], image, metadata)
         elif len(args) == 2:
             command, instance = args
             if command == 'destroy':
                 destroy(session, instance)
+            elif command == 'warm':
+                warm(instance)
             else:
                 print('Unknown command')
                 sys.exit(1)
@@ -95,27 +383,24 @@ def main(config, args):
         print('Write some help!')
 
 
-def _schedule(session, data, image):
-    """Try to schedule to one host.
+def _claim(session, allocation_requests, image, start=0, consumer=None,
+           metadata=None, context=None):
+    """Try to claim one of allocation_requests for consumer, or a new
+    consumer if it is None. metadata, if any, goes in the message, as
+    does the trace context, or a new one if it is None.
 
-    We start at the top of the available allocations and try to claim
-    each one. If there is a successful claim, then we break the loop
-    and are done. Otherwise we try the next allocation, continuing until
-    we run out.
+    We start at the allocation at index start and try to claim each one
+    in turn, wrapping around, until one succeeds or we run out. Returns
+    the target host and the message to send it, or (None, None).
     """
-    allocation_requests = data['allocation_requests']
-    # Not (yet) used.
-    # provider_summaries = data['provider_summaries']
-    consumer = str(uuid.uuid4())
-    target = None
-    while True:
-        try:
-            first_allocation = allocation_requests.pop(0)['allocations']
-        except IndexError:
-            print('NO ALLOCATIONS LEFT')
-            break
-
-        target = list(first_allocation.keys())[0]
+    consumer = consumer or str(uuid.uuid4())
+    context = context or trace.start()
+    claim_start = time.time()
+    count = len(allocation_requests)
+    for index in range(count):
+        allocation = allocation_requests[(start + index) % count]
+        first_allocation = allocation['allocations']
+        target = _target(allocation)
         claim = {
             'allocations': first_allocation,
             'user_id': str(uuid.uuid4()),
@@ -128,24 +413,279 @@ def _schedule(session, data, image):
             message = copy.deepcopy(claim)
             message['instance'] = consumer
             message['image'] = image
-            CLIENT.put('%s/%s/%s' % (PREFIX, target, consumer),
-                       json.dumps(message))
-            break
+            if metadata:
+                message['metadata'] = metadata
+            trace.span('claim', context, claim_start, time.time(),
+                       target=target, attempts=index + 1)
+            message['trace'] = context
+            return target, message
         else:
             print('CLAIM FAIL: %s' % resp.json())
-            target = None
-            continue
+    print('NO ALLOCATIONS LEFT')
+    trace.span('schedule', context, context['start'], time.time(),
+               span_id=context['span_id'], parent_id=False,
+               instance=consumer, outcome='no allocation')
+    return None, None
+
+
+def _key(target, message):
+    return '%s/%s/%s' % (PREFIX, target, message['instance'])
+
+
+def _notify_operations(target, message):
+    """Return the etcd operations that send message to target, and put
+    its metadata where the metadata server will find it, before the
+    instance can boot.
+    """
+    message['trace']['sent'] = time.time()
+    operations = [CLIENT.transactions.put(_key(target, message),
+                                          json.dumps(message))]
+    if message.get('metadata'):
+        operations.append(CLIENT.transactions.put(
+            '%s/%s/metadata' % (INSTANCES_PREFIX, message['instance']),
+            json.dumps(message['metadata'])))
+    return operations
+
+
+def _notified(message):
+    """Finish the trace of message, now it has been sent."""
+    context = message['trace']
+    now = time.time()
+    trace.span('notify', context, context['sent'], now)
+    trace.span('schedule', context, context['start'], now,
+               span_id=context['span_id'], parent_id=False,
+               instance=message['instance'])
+
+
+def _notify(target, message):
+    CLIENT.transaction(compare=[],
+                       success=_notify_operations(target, message),
+                       failure=[])
+    _notified(message)
+
 
+def _schedule(session, config, data, image, metadata=None, context=None):
+    """Try to schedule to one host.
+
+    We weigh the available allocations and, starting with the best, try
+    to claim each one. If there is a successful claim, then we notify
+    the target and are done. Otherwise we try the next allocation,
+    continuing until we run out. The instance is traced in context, or
+    a new trace if it is None.
+    """
+    context = context or trace.start()
+    allocation_requests = _weigh(config, data)
+    target, message = _claim(session, allocation_requests, image,
+                             metadata=metadata, context=context)
     if target:
-        print('NOTIFIED TARGET, %s, OF INSTANCE %s' % (target, consumer))
+        _notify(target, message)
+        print('NOTIFIED TARGET, %s, OF INSTANCE %s' % (
+            target, message['instance']))
         return True
 
     return False
 
 
+def _notify_all(claims):
+    """Send the messages for many claims in as few transactions as we
+    can, each holding the messages for one or more targets.
+    """
+    by_target = collections.defaultdict(list)
+    for target, message in claims:
+        by_target[target].extend(_notify_operations(target, message))
+    operations = []
+    for target_operations in by_target.values():
+        if len(operations) + len(target_operations) > MAX_TXN_OPS:
+            CLIENT.transaction(compare=[], success=operations)
+            operations = []
+        while len(target_operations) > MAX_TXN_OPS:
+            CLIENT.transaction(compare=[],
+                               success=target_operations[:MAX_TXN_OPS])
+            target_operations = target_operations[MAX_TXN_OPS:]
+        operations.extend(target_operations)
+    if operations:
+        CLIENT.transaction(compare=[], success=operations)
+    for target, message in claims:
+        _notified(message)
+
+
+def batch(session, config, wanted):
+    """Schedule many instances, given a list of (resources, image,
+    metadata).
+
+    Candidates are fetched and weighed once per distinct resources,
+    claims are made concurrently and the targets are notified in a few
+    transactions.
+    """
+    start_time = time.time()
+    candidates = {}
+    for resources in set(resources for resources, image, metadata in wanted):
+        resp = session.get(_candidates_url(resources))
+        if resp:
+            candidates[resources] = _weigh(config, resp.json())
+        else:
+            print('FAIL: %s: %s' % (resources, resp.json()))
+            candidates[resources] = []
+    candidates_time = time.time()
+    contexts = [trace.start(start_time) for _ in wanted]
+    for context in contexts:
+        trace.span('candidates', context, start_time, candidates_time)
+
+    # With the random weigher, start each claim at a different one of
+    # the best top_k candidates so they do not all race for the first
+    # one. pack and spread claim in the order they weigh.
+    if config['weigher'] == 'random':
+        rotate = config['weigher_top_k']
+    else:
+        rotate = 1
+    with concurrent.futures.ThreadPoolExecutor(
+            config['batch_workers']) as executor:
+        futures = [
+            executor.submit(_claim, session, candidates[resources], image,
+                            index % rotate,
+                            metadata=metadata, context=contexts[index])
+            for index, (resources, image, metadata) in enumerate(wanted)]
+        results = []
+        for future in futures:
+            # One claim failing, such as on a placement error, must not
+            # stop the others being sent, or their allocations leak.
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                print('CLAIM ERROR: %s' % exc)
+                results.append((None, None))
+
+    claims = [result for result in results if result[0]]
+    _notify_all(claims)
+    elapsed = time.time() - start_time
+
+    print('%-36s  %-36s  %s' % ('INSTANCE', 'TARGET', 'RESOURCES'))
+    for (resources, image, _), (target, message) in zip(wanted, results):
+        instance = message['instance'] if message else '-'
+        print('%-36s  %-36s  %s' % (instance, target or 'FAILED', resources))
+    print('SCHEDULED %s of %s in %.2fs (%.1f/s)' % (
+        len(claims), len(wanted), elapsed, len(claims) / elapsed))
+    return len(claims) == len(wanted)
+
+
+def _batch_wanted(args, metadata=None):
+    """Turn batch arguments into a list of (resources, image, metadata).
+
+    Either ``<count> <resources> [image]`` or a manifest file, a yaml
+    list of mappings with resources and optional image, count,
+    user-data (text) and meta-data (a mapping). metadata is used for
+    instances that are given neither.
+    """
+    if args[0].isdigit():
+        image = args[2] if len(args) > 2 else IMAGE
+        return [(args[1], image, metadata)] * int(args[0])
+    wanted = []
+    with open(args[0]) as manifest:
+        for entry in yaml.safe_load(manifest):
+            entry_metadata = {key: entry[key]
+                              for key in ('user-data', 'meta-data')
+                              if key in entry}
+            wanted.extend([(entry['resources'], entry.get('image', IMAGE),
+                            entry_metadata or metadata)]
+                          * entry.get('count', 1))
+    return wanted
+
+
+def request(resources, image, metadata=None):
+    """Put a request for an instance on the queue read by daemon."""
+    request_id = str(uuid.uuid4())
+    key = '%s/%s' % (REQUESTS_PREFIX, request_id)
+    data = {'resources': resources, 'image': image}
+    if metadata:
+        data['metadata'] = metadata
+    CLIENT.put(key, json.dumps(data))
+    print('REQUESTED %s, RESULT WILL BE AT %s/result' % (request_id, key))
+
+
+def _handle_request(session, config, key, value):
+    """Schedule one request from the queue, writing the result next to
+    it, at <key>/result, and deleting the request.
+    """
+    result = {'instance': None, 'target': None}
+    try:
+        data = json.loads(value)
+        resources = data['resources']
+        context = trace.start()
+        resp = session.get(_candidates_url(resources))
+        trace.span('candidates', context, context['start'], time.time())
+        if resp:
+            # Requests handed back by a busy compute name the instance
+            # and exclude that compute.
+            exclude = set(data.get('exclude', []))
+            allocation_requests = [
+                allocation for allocation in _weigh(config, resp.json())
+                if _target(allocation) not in exclude]
+            target, message = _claim(session, allocation_requests,
+                                     data.get('image') or IMAGE,
+                                     consumer=data.get('instance'),
+                                     metadata=data.get('metadata'),
+                                     context=context)
+            if target:
+                _notify(target, message)
+                result = {'instance': message['instance'], 'target': target}
+                print('NOTIFIED TARGET, %s, OF INSTANCE %s' % (
+                    target, message['instance']))
+            else:
+                result['error'] = 'no allocation available'
+        else:
+            result['error'] = resp.text
+    except Exception as exc:
+        result['error'] = str(exc)
+    if 'error' in result:
+        print('FAIL: %s: %s' % (key, result['error']))
+    lease = None
+    if config['result_ttl']:
+        lease = CLIENT.lease(config['result_ttl'])
+    CLIENT.transaction(
+        compare=[],
+        success=[CLIENT.transactions.put('%s/result' % key,
+                                         json.dumps(result), lease=lease),
+                 CLIENT.transactions.delete(key)],
+        failure=[])
+
+
+def _is_request(key):
+    """Requests are at /requests/<id>, results below them."""
+    return key.count('/') == 2
+
+
+def daemon(session, config):
+    """Schedule requests put under REQUESTS_PREFIX, forever.
+
+    Requests already there without a result are done first, then new
+    ones are watched for, from the revision the existing ones were read
+    at, so none are missed.
+    """
+    prefix = REQUESTS_PREFIX + '/'
+    executor = concurrent.futures.ThreadPoolExecutor(config['daemon_workers'])
+
+    def _submit(key, value):
+        executor.submit(_handle_request, session, config, key, value)
+
+    response = CLIENT.get_prefix_response(prefix)
+    existing = {kv.key.decode('utf-8'): kv.value for kv in response.kvs}
+    for key, value in existing.items():
+        if _is_request(key) and '%s/result' % key not in existing:
+            _submit(key, value)
+
+    print('WAITING FOR REQUESTS AT %s' % prefix)
+    events_iterator, cancel = CLIENT.watch_prefix(
+        prefix, start_revision=response.header.revision + 1)
+    for event in events_iterator:
+        key = event.key.decode('utf-8')
+        if isinstance(event, etcd3.events.PutEvent) and _is_request(key):
+            _submit(key, event.value)
+
+
 def run():
     global CLIENT, CONFIG
     config = conf.configure(CONFIG, 'schedule.yaml')
+    trace.configure(config['trace_file'], 'eschedule')
     if config['etcd']:
         CLIENT = etcd3.client(**config['etcd'])
     else:
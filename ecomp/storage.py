@@ -0,0 +1,82 @@
+"""Instance disks, spread over one or more storage directories.
+
+A directory is picked for each new instance disk by how busy its block
+device is right now (the I/Os in flight, from sysfs) and then by free
+space, so that disk heavy builds run on several devices at once. An
+instance's disk is always ``<directory>/<instance>.img``, which is how
+it is found again.
+"""
+
+import os
+import uuid
+
+import psutil
+
+from ecomp import images
+
+
+def is_instance(name):
+    """Say if name is an instance uuid."""
+    try:
+        uuid.UUID(name)
+    except ValueError:
+        return False
+    return True
+
+
+def _in_flight(path):
+    """Return the number of I/Os in flight on the device under path."""
+    dev = os.stat(path).st_dev
+    stat_file = '/sys/dev/block/%d:%d/stat' % (os.major(dev), os.minor(dev))
+    try:
+        with open(stat_file) as stat:
+            return int(stat.read().split()[8])
+    except (FileNotFoundError, IndexError, ValueError):
+        # Not a block device, such as tmpfs.
+        return 0
+
+
+def pick(paths, size_gb):
+    """Return the path for a new disk of size_gb.
+
+    Paths with room are preferred, least busy first, then with most free
+    space.
+    """
+    choices = []
+    for path in paths:
+        free = psutil.disk_usage(path).free
+        full = free < size_gb * images.GB
+        choices.append((full, _in_flight(path), -free, path))
+    return min(choices)[-1]
+
+
+def disk_path(path, instance):
+    return os.path.abspath(os.path.join(path, '%s.img' % instance))
+
+
+def find(paths, instance):
+    """Return the disk of instance, or None if there is none."""
+    for path in paths:
+        disk = disk_path(path, instance)
+        if os.path.exists(disk):
+            return disk
+    return None
+
+
+def devices(paths):
+    """Return one path per distinct device among paths."""
+    by_device = {}
+    for path in paths:
+        by_device.setdefault(os.stat(path).st_dev, path)
+    return list(by_device.values())
+
+
+def instance_bytes(paths):
+    """Return the space actually used by instance disks under paths."""
+    used = 0
+    for path in paths:
+        for name in os.listdir(path):
+            instance, _, extension = name.partition('.')
+            if extension == 'img' and is_instance(instance):
+                used += os.stat(os.path.join(path, name)).st_blocks * 512
+    return used
@@ -0,0 +1,131 @@
+"""Trace each boot from eschedule, through etcd, to the guest's IP.
+
+eschedule starts a trace when it schedules an instance, records spans
+for getting allocation candidates, claiming and notifying the compute,
+and carries the trace in the message, as ``trace``: the trace id, the
+id of its root span, when that started and when the message was sent.
+ecompute continues the trace with a span for the message in transit
+(from sent until ecompute has it, so subject to the clocks of the two
+hosts agreeing) and a span for the build, holding spans for the time
+queued for and spent in each stage, and waiting for an IP.
+
+Spans are written, one JSON object per line, to the file configured
+with ``configure``. Each is a span in the Zipkin v2 format, so the
+lines of one or more files, made into a JSON list, can be posted to a
+Zipkin compatible collector at ``/api/v2/spans``. Nothing is recorded
+when there is no file, and a span that cannot be written is dropped,
+never holding up a build.
+"""
+
+import json
+import random
+import threading
+import time
+
+EXPORT = {'file': None, 'service': None}
+LOCK = threading.Lock()
+# The builds being traced, by instance: {'context', 'span_id', 'start',
+# 'last'}
+BUILDS = {}
+
+
+def configure(path, service):
+    """Write spans, from service, to the file at path, or to nowhere if
+    path is None.
+    """
+    EXPORT['file'] = open(path, 'a') if path else None
+    EXPORT['service'] = service
+
+
+def new_id(bits=64):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+def start(started=None):
+    """Return the context of a new trace, whose root span starts at
+    started, or now.
+    """
+    return {'trace_id': new_id(128), 'span_id': new_id(),
+            'start': started or time.time()}
+
+
+def span(name, context, start, end, span_id=None, parent_id=None,
+         **tags):
+    """Record the span name, from start to end, in the trace of context.
+
+    Its parent is the root span of context unless parent_id is given.
+    The root span itself is recorded by giving span_id as the root span
+    id and parent_id as False.
+    """
+    if EXPORT['file'] is None or not context:
+        return
+    record = {
+        'traceId': context['trace_id'],
+        'id': span_id or new_id(),
+        'name': name,
+        'timestamp': int(start * 1000000),
+        'duration': max(int((end - start) * 1000000), 1),
+        'localEndpoint': {'serviceName': EXPORT['service']},
+    }
+    if parent_id is not False:
+        record['parentId'] = parent_id or context['span_id']
+    if tags:
+        record['tags'] = {key: str(value) for key, value in tags.items()}
+    line = json.dumps(record) + '\n'
+    with LOCK:
+        try:
+            EXPORT['file'].write(line)
+            EXPORT['file'].flush()
+        except (OSError, ValueError) as exc:
+            print('trace export saw %s' % exc)
+
+
+def begin(instance, context):
+    """Continue the trace of context with the build of instance."""
+    if EXPORT['file'] is None or not context:
+        return
+    now = time.time()
+    build = {'context': context, 'span_id': new_id(), 'start': now,
+             'last': now}
+    with LOCK:
+        BUILDS[instance] = build
+    if 'sent' in context:
+        span('transport', context, min(context['sent'], now), now)
+
+
+def stage(instance, name, queued, started, finished):
+    """Record the time instance was queued for, and then in, the stage
+    name.
+    """
+    with LOCK:
+        build = BUILDS.get(instance)
+        if build is None:
+            return
+        build['last'] = finished
+    span('%s queued' % name, build['context'], queued, started,
+         parent_id=build['span_id'])
+    span(name, build['context'], started, finished,
+         parent_id=build['span_id'])
+
+
+def phase(instance, name):
+    """Record a span for instance, named name, from the end of the last
+    until now.
+    """
+    now = time.time()
+    with LOCK:
+        build = BUILDS.get(instance)
+        if build is None:
+            return
+        last, build['last'] = build['last'], now
+    span(name, build['context'], last, now, parent_id=build['span_id'])
+
+
+def finish(instance, outcome):
+    """Record the build of instance, which ended with outcome."""
+    with LOCK:
+        build = BUILDS.pop(instance, None)
+    if build is None:
+        return
+    span('build', build['context'], build['start'], time.time(),
+         span_id=build['span_id'], instance=instance, outcome=outcome)
@@ -2,88 +2,298 @@ import sys
 import os
 import logging
 import json
+import socketserver
+import threading
+import time
+from xml.etree import ElementTree
 
 import bottle
 from bottle import route, run, template
 
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+try:
+    import etcd3
+except ImportError:
+    etcd3 = None
+
+INSTANCES_PREFIX = '/instances/'
+
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
 LOG.addHandler(logging.StreamHandler())
 
 
+class DomainIndex(object):
+    """Map guest IP to MAC to domain name, in memory.
+
+    The dnsmasq lease file gives IP to MAC and the domain db (a JSON
+    object of MAC to domain name) or libvirt gives MAC to domain. A
+    file is only read again when its mtime changes, which is checked
+    at most every interval seconds, or straight away when an IP is not
+    known, as it will not be for a guest whose lease has just been
+    written. With libvirt, domains are listed again when libvirt says
+    one has been defined, started or undefined.
+    """
+
+    def __init__(self, lease_file, domain_db, interval=1):
+        self.lease_file = lease_file
+        self.domain_db = domain_db
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.mtimes = {}
+        self.macs = {}
+        self.domains = {}
+        self.libvirt_domains = {}
+        self.conn = None
+        self.stale = False
+
+    def _changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        changed = mtime != self.mtimes.get(path)
+        self.mtimes[path] = mtime
+        return changed and mtime is not None
+
+    def _read_leases(self):
+        macs = {}
+        with open(self.lease_file) as leases:
+            for line in leases:
+                # expiry mac ip hostname client-id
+                line_parts = line.split()
+                if len(line_parts) > 2:
+                    macs[line_parts[2]] = line_parts[1]
+        self.macs = macs
+
+    def _read_domain_db(self):
+        with open(self.domain_db) as domain_db:
+            self.domains = json.loads(domain_db.readline())
+
+    def _list_domains(self):
+        domains = {}
+        for dom in self.conn.listAllDomains():
+            xml = ElementTree.fromstring(dom.XMLDesc(0))
+            for mac in xml.findall('./devices/interface/mac'):
+                domains[mac.get('address').lower()] = dom.name()
+        self.libvirt_domains = domains
+
+    def _refresh(self, force=False):
+        now = time.time()
+        if not force and now - self.checked < self.interval:
+            return
+        self.checked = now
+        if self._changed(self.lease_file):
+            self._read_leases()
+        if self.domain_db and self._changed(self.domain_db):
+            self._read_domain_db()
+        if self.stale:
+            self.stale = False
+            self._list_domains()
+
+    def watch_libvirt(self, uri):
+        """List domains from libvirt, and again each time they change."""
+        libvirt.virEventRegisterDefaultImpl()
+        self.conn = libvirt.openReadOnly(uri)
+        self.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._event, None)
+        self.stale = True
+
+        def _run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        thread = threading.Thread(target=_run)
+        thread.daemon = True
+        thread.start()
+
+    def _event(self, conn, dom, event, detail, opaque):
+        if event in (libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                     libvirt.VIR_DOMAIN_EVENT_STARTED,
+                     libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+            self.stale = True
+            self.checked = 0
+
+    def lookup(self, ip):
+        """Return the MAC and domain name of the guest at ip, each of
+        which may be None.
+        """
+        with self.lock:
+            self._refresh()
+            if ip not in self.macs:
+                self._refresh(force=True)
+            mac = self.macs.get(ip)
+            if mac is None:
+                return None, None
+            mac = mac.lower()
+            return mac, (self.libvirt_domains.get(mac)
+                         or self.domains.get(mac))
+
+
+class InstanceMetadata(object):
+    """The user-data and meta-data of each instance, kept from etcd.
+
+    eschedule puts them at /instances/<instance>/metadata, as JSON with
+    'user-data' and 'meta-data' keys. They are all read at startup and
+    then kept up to date by a watch, so a guest's request never waits
+    on etcd. An instance is known by its domain name.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        # instance: (metadata, mod_revision)
+        self.instances = {}
+
+    def start(self):
+        response = self.client.get_prefix_response(INSTANCES_PREFIX)
+        for kv in response.kvs:
+            self._update(kv.key, kv.value, kv.mod_revision)
+        self.client.add_watch_prefix_callback(
+            INSTANCES_PREFIX, self._watch_callback,
+            start_revision=response.header.revision + 1)
+
+    def _update(self, key, value, revision):
+        instance, _, name = str(key, 'UTF-8')[
+            len(INSTANCES_PREFIX):].partition('/')
+        if name != 'metadata':
+            return
+        if value:
+            self.instances[instance] = (json.loads(str(value, 'UTF-8')),
+                                        revision)
+        else:
+            self.instances.pop(instance, None)
+
+    def _watch_callback(self, response):
+        if isinstance(response, Exception):
+            LOG.error("instance metadata watch saw %s" % response)
+            return
+        for event in response.events:
+            if isinstance(event, etcd3.events.PutEvent):
+                self._update(event.key, event.value, event.mod_revision)
+            else:
+                self._update(event.key, None, event.mod_revision)
+
+    def get(self, instance):
+        """Return (metadata, revision) for instance, or (None, None)."""
+        return self.instances.get(instance, (None, None))
+
+
 class MetadataHandler(object):
+    """Answer metadata requests from responses made once per instance.
 
-    def _get_mgmt_mac(self):
-        lease_file = '/var/lib/libvirt/dnsmasq/default.leases'
-        client_host = bottle.request.get('REMOTE_ADDR')
-        for line in open(lease_file):
-            line_parts = line.split(" ")
-            if client_host == line_parts[2]:
-                mac = line_parts[1]
-                return mac
-
-    def _get_hostname_from_libvirt_domain(self):
-        mac_addr = self._get_mgmt_mac()
-        domain_mac_db = open('/etc/libvirt/qemu_db').readline()
-        json_db = json.loads(domain_mac_db)
-        domain_name = json_db.get(mac_addr)
-        return domain_name
+    An instance is known by its IP. Its responses are made the first
+    time it asks for anything, and again only if a different guest (or
+    a domain that has since been found) turns up at that IP or its
+    metadata changes. What is the same for every instance, such as the
+    public keys and default user-data, is made once.
+    """
 
-    def gen_metadata(self):
-        res = ["instance-id",
-               "hostname",
-               "public-keys",
-               ""]
-        return self.make_content(res)
+    def __init__(self, index, config, metadata=None):
+        self.index = index
+        self.config = config
+        self.instance_metadata = metadata
+        self.keys = [key.split('.')[1] for key in config
+                     if key.startswith('public-keys.')]
+        self.key_files = {
+            key: self.make_content(config['public-keys.%s' % key])
+            for key in self.keys}
+        self.user_data = self._read_userdata()
+        self.metadata = self.make_content(["instance-id",
+                                           "hostname",
+                                           "public-keys",
+                                           ""])
+        self.public_keys = self.make_content(self.keys + [""])
+        self.lock = threading.Lock()
+        self.instances = {}
 
-    def gen_userdata(self):
-        config = bottle.request.app.config
-        user_data_file = config['user-data.default']
+    def _read_userdata(self):
+        user_data_file = self.config.get('user-data.default')
         if user_data_file:
             with open(user_data_file) as user_data:
                 return self.make_content(user_data.read())
         return self.make_content('')
 
-    def gen_hostname_old(self):
+    def _instance(self):
+        """Return the responses for the instance making the request."""
         client_host = bottle.request.get('REMOTE_ADDR')
-        prefix = bottle.request.app.config['mdserver.hostname-prefix']
-        res = "%s-%s" % (prefix, client_host.split('.')[-1])
-        return self.make_content(res)
-
-    def gen_hostname(self):
         try:
-            hostname = self._get_hostname_from_libvirt_domain()
+            guest = self.index.lookup(client_host)
         except Exception as e:
             LOG.error("Exception %s" % e)
-            return self.gen_hostname_old()
+            guest = (None, None)
+        metadata, revision = None, None
+        if self.instance_metadata and guest[1]:
+            metadata, revision = self.instance_metadata.get(guest[1])
+        guest += (revision,)
+        with self.lock:
+            responses = self.instances.get(client_host)
+        if responses is None or responses['guest'] != guest:
+            responses = self._responses(client_host, guest, metadata)
+            with self.lock:
+                self.instances[client_host] = responses
+        return responses
 
+    def _responses(self, client_host, guest, metadata):
+        mac, hostname, revision = guest
         if not hostname:
-            return self.gen_hostname_old()
-        return hostname
+            prefix = self.config['mdserver.hostname-prefix']
+            hostname = self.make_content(
+                "%s-%s" % (prefix, client_host.split('.')[-1]))
+        responses = {
+            'guest': guest,
+            'hostname': hostname,
+            'instance-id': self.make_content("i-%s" % client_host),
+            'meta-data': self.metadata,
+            'user-data': self.user_data,
+            'keys': {},
+        }
+        if metadata:
+            if metadata.get('user-data') is not None:
+                responses['user-data'] = metadata['user-data']
+            # meta-data may give hostname and instance-id as well as
+            # keys of its own.
+            for key, value in (metadata.get('meta-data') or {}).items():
+                if key in ('hostname', 'instance-id'):
+                    responses[key] = self.make_content(str(value))
+                else:
+                    responses['keys'][key] = self.make_content(str(value))
+            if responses['keys']:
+                responses['meta-data'] = self.make_content(
+                    ["instance-id", "hostname", "public-keys"]
+                    + sorted(responses['keys']) + [""])
+        return responses
+
+    def gen_metadata(self):
+        return self._instance()['meta-data']
+
+    def gen_userdata(self):
+        return self._instance()['user-data']
+
+    def gen_hostname(self):
+        return self._instance()['hostname']
 
     def gen_public_keys(self):
-        res = bottle.request.app.config.keys()
-        _keys = filter(lambda x: x.startswith('public-keys'), res)
-        keys = list(map(lambda x: x.split('.')[1], _keys))
-        keys.append("")
-        return self.make_content(keys)
+        return self.public_keys
 
     def gen_public_key_dir(self, key):
+        keys = self._instance()['keys']
+        if key in keys:
+            return keys[key]
         res = ""
-        if key in self.gen_public_keys():
+        if key in self.keys:
             res = "openssh-key"
         return self.make_content(res)
 
     def gen_public_key_file(self, key='default'):
-        if key not in self.gen_public_keys():
-            key = 'default'
-        res = bottle.request.app.config['public-keys.%s' % key]
-        return self.make_content(res)
+        return self.key_files.get(key, self.key_files['default'])
 
     def gen_instance_id(self):
-        client_host = bottle.request.get('REMOTE_ADDR')
-        iid = "i-%s" % client_host
-        return self.make_content(iid)
+        return self._instance()['instance-id']
 
     def make_content(self, res):
         if isinstance(res, list):
@@ -92,6 +302,29 @@ class MetadataHandler(object):
             return "%s\n" % res
 
 
+class ThreadingServer(bottle.ServerAdapter):
+    """wsgiref, with a thread per request, so a slow guest does not
+    hold up the others.
+    """
+
+    def run(self, handler):
+        from wsgiref import simple_server
+
+        class Server(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+            daemon_threads = True
+
+        class Handler(simple_server.WSGIRequestHandler):
+            def log_request(*args, **kwargs):
+                if not self.quiet:
+                    simple_server.WSGIRequestHandler.log_request(
+                        *args, **kwargs)
+
+        server = simple_server.make_server(self.host, self.port, handler,
+                                           server_class=Server,
+                                           handler_class=Handler)
+        server.serve_forever()
+
+
 def main():
     app = bottle.default_app()
     app.config['mdserver.md-base'] = "/2009-04-04"
@@ -99,6 +332,16 @@ def main():
     app.config['mdserver.hostname-prefix'] = 'vm'
     app.config['public-keys.default'] = "__NOT_CONFIGURED__"
     app.config['mdserver.port'] = 80
+    app.config['mdserver.lease-file'] = \
+        '/var/lib/libvirt/dnsmasq/default.leases'
+    app.config['mdserver.domain-db'] = '/etc/libvirt/qemu_db'
+    # A libvirt uri, such as qemu:///system, to find domains from.
+    app.config['mdserver.libvirt'] = ''
+    # host:port of etcd, to serve the user-data and meta-data eschedule
+    # gives each instance. Instances are found by domain name.
+    app.config['mdserver.etcd'] = ''
+    # 'threading', or the name of any bottle server adapter.
+    app.config['mdserver.server'] = 'threading'
 
 
     if len(sys.argv) > 1:
@@ -112,7 +355,23 @@ def main():
     if app.config['public-keys.default'] == "__NOT_CONFIGURED__":
         LOG.info("================Default public key not set !!!==============")
 
-    mdh = MetadataHandler()
+    index = DomainIndex(app.config['mdserver.lease-file'],
+                        app.config['mdserver.domain-db'])
+    if app.config['mdserver.libvirt']:
+        if libvirt is None:
+            LOG.error("libvirt is not installed, not watching domains")
+        else:
+            index.watch_libvirt(app.config['mdserver.libvirt'])
+    metadata = None
+    if app.config['mdserver.etcd']:
+        if etcd3 is None:
+            LOG.error("etcd3 is not installed, no instance metadata")
+        else:
+            host, _, port = app.config['mdserver.etcd'].partition(':')
+            metadata = InstanceMetadata(
+                etcd3.client(host=host, port=int(port or 2379)))
+            metadata.start()
+    mdh = MetadataHandler(index, app.config, metadata)
     route(app.config['mdserver.md-base'] + '/meta-data/',
           'GET', mdh.gen_metadata)
     route(app.config['mdserver.md-base'] + '/user-data',
@@ -138,7 +397,10 @@ def main():
     route('/latest' + '/meta-data/public-keys//<key>/openssh-key',
           'GET', mdh.gen_public_key_file)
     svr_port = app.config.get('mdserver.port')
-    run(host='169.254.169.254', port=svr_port)
+    server = app.config.get('mdserver.server')
+    if server == 'threading':
+        server = ThreadingServer
+    run(host='169.254.169.254', port=svr_port, server=server)
 
 if __name__ == '__main__':
     main()
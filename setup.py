@@ -20,7 +20,6 @@ setup(
         'requests',
         'PyYAML',
         "libvirt-python; sys_platform != 'darwin'",
-        'cachecontrol[filecache]',
         'bottle',
         'psutil',
     ],